@@ -22,7 +22,8 @@ from .api import (
     send_email,
     fetch_crypto_data,
     get_url,
-    navigate_and_screenshot
+    navigate_and_screenshot,
+    navigate_and_screenshot_many
 )
 
 # Import function from frontpage.py
@@ -44,6 +45,7 @@ __all__ = [
     'fetch_crypto_data',
     'get_url',
     'navigate_and_screenshot',
+    'navigate_and_screenshot_many',
     'fetch_paper',
     'extract_weather_info'
 ]
@@ -7,13 +7,24 @@ import requests
 import re
 import json
 import os
+import base64
+from types import SimpleNamespace
 from retrying import retry
 from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+import cassette
+import metrics
+import time
+import yaml
+
 from dotenv import load_dotenv
 load_dotenv()
 anthropic_client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
@@ -24,13 +35,96 @@ parser.add_argument(
     '--loglevel',
     default='WARNING',
     help='Set the logging level')
-args = parser.parse_args()
+args, _ = parser.parse_known_args()
 log_level = args.loglevel.upper()
 logging.basicConfig(
     level=log_level,
     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+# Used when models.yml is missing or lacks the requested tier
+DEFAULT_ROUTE = {'model': 'claude-3-5-sonnet-20240620', 'max_tokens': 4096}
+
+_model_routes = None
+
+
+def load_model_routes():
+    global _model_routes
+    if _model_routes is None:
+        path = os.getenv('MODEL_ROUTES', 'models.yml')
+        try:
+            with open(path, 'r') as file:
+                _model_routes = yaml.safe_load(file) or {}
+        except FileNotFoundError:
+            logging.warning(f"Model routing table {path} not found, using defaults")
+            _model_routes = {}
+    return _model_routes
+
+
+def _tier_route(tier=None):
+    routes = load_model_routes()
+    tier = tier or routes.get('default_tier', 'standard')
+    route = routes.get('tiers', {}).get(tier)
+    if route is None:
+        logging.warning(f"Unknown model tier {tier}, using the default route")
+        route = DEFAULT_ROUTE
+    return tier, route
+
+
+def tier_max_tokens(tier=None):
+    """Return the output cap of a task tier, for call sites that batch work."""
+    _, route = _tier_route(tier)
+    return route.get('max_tokens', DEFAULT_ROUTE['max_tokens'])
+
+
+def resolve_route(tier=None, max_tokens=None):
+    """
+    Return (tier, model, max_tokens) for a call site's task tier and
+    output budget, using the smaller of the budget and the tier's limit.
+    """
+    tier, route = _tier_route(tier)
+    limit = route.get('max_tokens', DEFAULT_ROUTE['max_tokens'])
+    if max_tokens and max_tokens > limit:
+        logging.warning(
+            f"Requested max_tokens {max_tokens} exceeds the {tier} tier limit, "
+            f"clamping to {limit}; the response may be truncated")
+    return tier, route.get('model', DEFAULT_ROUTE['model']), min(max_tokens or limit, limit)
+
+
+def _encode_content(content):
+    return [{'type': block.type, 'text': getattr(block, 'text', None)}
+            for block in content]
+
+
+def _decode_content(blocks):
+    return [SimpleNamespace(**block) for block in blocks]
+
+
+def _encode_response(response):
+    return {
+        'status_code': response.status_code,
+        'url': response.url,
+        'headers': dict(response.headers),
+        'content': base64.b64encode(response.content).decode('ascii'),
+    }
+
+
+def _decode_response(data):
+    response = requests.Response()
+    response.status_code = data['status_code']
+    response.url = data['url']
+    response.reason = ''
+    response.headers.update(data['headers'])
+    response._content = base64.b64decode(data['content'])
+    response._content_consumed = True
+    return response
+
+
+@cassette.recorded(
+    'anthropic',
+    encode=_encode_content,
+    decode=_decode_content,
+    shape=lambda messages, temperature=0.0, max_tokens=None, model=None, tier=None: [model, tier])
 @retry(stop_max_attempt_number=3,
        wait_exponential_multiplier=100,
        wait_exponential_max=1000)
@@ -38,20 +132,31 @@ logging.basicConfig(
 def generate_anthropic_response(
         messages,
         temperature=0.0,
-        max_tokens=4096,
-        model="claude-3-5-sonnet-20240620"):
+        max_tokens=None,
+        model=None,
+        tier=None):
+    tier, routed_model, max_tokens = resolve_route(tier, max_tokens)
+    model = model or routed_model
     try:
+        started = time.perf_counter()
         response = anthropic_client.messages.create(
             model=model,
             max_tokens=max_tokens,
             temperature=temperature,
             messages=messages)
+        metrics.record_llm(
+            time.perf_counter() - started,
+            response.usage.input_tokens,
+            response.usage.output_tokens,
+            model,
+            tier)
         return response.content
     except Exception as e:
         print(f"Unexpected error: {e}")
         raise
 
 
+@cassette.recorded('playwright', shape=cassette.url_shape)
 def navigate(url):
     try:
         with sync_playwright() as p:
@@ -67,6 +172,10 @@ def navigate(url):
         return str(e)
 
 
+@cassette.recorded(
+    'playwright',
+    files=lambda url, screenshot_path="screenshot.png", *args, **kwargs: [screenshot_path],
+    shape=lambda url, *args, **kwargs: cassette.url_shape(url))
 def navigate_and_screenshot(
         url,
         screenshot_path="screenshot.png",
@@ -91,6 +200,59 @@ def navigate_and_screenshot(
         return str(e)
 
 
+@cassette.recorded(
+    'playwright',
+    files=lambda targets, *args, **kwargs: [path for _, path in targets],
+    shape=lambda targets, *args, **kwargs: [cassette.url_shape(url) for url, _ in targets])
+def navigate_and_screenshot_many(targets, width=1280, height=720):
+    """
+    Screenshot several pages in parallel tabs of one browser session.
+    targets is a list of (url, screenshot_path) pairs; returns a list of
+    booleans telling which screenshots were taken.
+    """
+    async def capture():
+        async with async_playwright() as p:
+            browser = await p.firefox.launch()
+            context = await browser.new_context(
+                viewport={
+                    'width': width,
+                    'height': height})
+
+            async def screenshot(url, screenshot_path):
+                try:
+                    page = await context.new_page()
+                    await page.goto(url)
+                    await page.wait_for_load_state('networkidle')
+                    await page.wait_for_timeout(5000)
+                    await page.screenshot(path=screenshot_path)
+                    return True
+                except Exception as e:
+                    logging.error(f"Failed to screenshot {url}: {str(e)}")
+                    return False
+
+            results = await asyncio.gather(
+                *(screenshot(url, path) for url, path in targets))
+            await browser.close()
+            return list(results)
+
+    return asyncio.run(capture())
+
+
+def http_get(url, params=None):
+    def fetch():
+        response = requests.get(url, params=params)
+        metrics.add_bytes(len(response.content))
+        return response
+
+    return cassette.call(
+        'http',
+        [url, params],
+        fetch,
+        encode=_encode_response,
+        decode=_decode_response,
+        shape=cassette.url_shape(url))
+
+
 def get_url(url):
     html = navigate(url)
     if html is None:
@@ -99,6 +261,7 @@ def get_url(url):
     return h.handle(html)
 
 
+@cassette.recorded('smtp')
 def send_email(subject, body):
     sender_email = os.environ["SENDER_EMAIL"]
     receiver_email = os.environ["RECEIVER_EMAIL"]
@@ -127,27 +290,110 @@ def send_email(subject, body):
         raise
 
 
+# CoinGecko /coins/markets returns at most 250 coins per page, and long
+# ids lists run into URL length limits
+COINGECKO_MAX_PER_PAGE = 250
+# Keeps the query string well under the common 8 KB URL limit, so chunks
+# are usually bounded by the page size instead
+COINGECKO_MAX_IDS_CHARS = 6000
+
+
+class RateLimiter:
+    """
+    Token bucket shared across threads: up to `burst` calls may start at
+    once, and tokens refill at requests_per_minute.
+    """
+
+    def __init__(self, requests_per_minute, burst=1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now, possibly going negative; the deficit is
+            # the time this caller has to wait for it to refill
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        time.sleep(delay)
+
+
+def chunk_ids(crypto_ids, max_ids=COINGECKO_MAX_PER_PAGE, max_chars=COINGECKO_MAX_IDS_CHARS):
+    """
+    Split ids into chunks that fit in one page and one query string.
+    Commas are counted as their URL-encoded length of 3.
+    """
+    chunks = [[]]
+    length = 0
+    for crypto_id in dict.fromkeys(crypto_ids):
+        added = len(crypto_id) + (3 if chunks[-1] else 0)
+        if chunks[-1] and (len(chunks[-1]) >= max_ids or length + added > max_chars):
+            chunks.append([])
+            length = 0
+            added = len(crypto_id)
+        chunks[-1].append(crypto_id)
+        length += added
+    return [chunk for chunk in chunks if chunk]
+
+
 def fetch_crypto_data(
         crypto_ids,
         vs_currency='usd',
         order='market_cap_desc',
         per_page=100,
-        price_change_percentage='24h'):
+        price_change_percentage='24h',
+        requests_per_minute=30,
+        max_workers=4):
+    """
+    Fetch market data for any number of coins. The ids are split into
+    chunks that are fetched concurrently under a rate limit, and the
+    results are merged and deduplicated. Chunks that fail are logged and
+    left out, so the result may be partial. Returns up to per_page coins
+    (all of them if per_page is None) in the requested order.
+    """
     base_url = "https://api.coingecko.com/api/v3/coins/markets"
-    params = {
-        "vs_currency": vs_currency,
-        "ids": ",".join(crypto_ids),
-        "order": order,
-        "per_page": per_page,
-        "page": 1,
-        "sparkline": False,
-        "price_change_percentage": price_change_percentage
-    }
+    chunks = chunk_ids(crypto_ids)
+    if not chunks:
+        return []
+    workers = min(max_workers, len(chunks))
+    limiter = RateLimiter(requests_per_minute, burst=workers)
 
-    try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        return response.json()
-    except requests.RequestException as e:
-        print(f"An error occurred while fetching crypto data: {e}")
-        return None
+    def fetch(chunk):
+        params = {
+            "vs_currency": vs_currency,
+            "ids": ",".join(chunk),
+            "order": order,
+            "per_page": len(chunk),
+            "page": 1,
+            "sparkline": False,
+            "price_change_percentage": price_change_percentage
+        }
+        limiter.wait()
+        try:
+            response = http_get(base_url, params=params)
+            response.raise_for_status()  # Raises an HTTPError for bad responses
+            return response.json()
+        except requests.RequestException as e:
+            logging.error(f"An error occurred while fetching crypto data for {len(chunk)} coins: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch, chunks))
+
+    failed = sum(1 for result in results if result is None)
+    if failed:
+        logging.warning(f"{failed} of {len(chunks)} crypto data requests failed, returning partial results")
+
+    coins = {}
+    for result in results:
+        for coin in result or []:
+            coins.setdefault(coin['id'], coin)
+    coins = list(coins.values())
+    if order == 'market_cap_desc':
+        coins.sort(key=lambda coin: coin.get('market_cap') or 0, reverse=True)
+    return coins if per_page is None else coins[:per_page]
@@ -0,0 +1,175 @@
+"""
+Record and replay of external I/O.
+
+With --record, every call wrapped by `recorded` or `call` (Claude, HTTP,
+Playwright, SMTP and front-page downloads) is executed and its result,
+duration and any files it wrote are captured into a gzip-compressed JSON
+cassette. With --replay, the same calls are answered from the cassette
+without touching the network, either instantly or with the recorded
+latency.
+
+Calls are matched by kind and a hash of their arguments. When no exact
+match exists (for example a prompt that contains today's date), the next
+unused entry of the same kind and call shape (such as the URL without its
+query string, or the function and model tier) is served in recording
+order, with a warning.
+"""
+import base64
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+_mode = None
+_path = None
+_latency = 'zero'
+_entries = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def start(mode, path, latency='zero'):
+    """Enter 'record' or 'replay' mode for the given cassette file."""
+    global _mode, _path, _latency, _entries
+    if mode not in ('record', 'replay'):
+        raise ValueError(f"Unknown cassette mode: {mode}")
+    _mode, _path, _latency = mode, path, latency
+    _entries = []
+    if mode == 'replay':
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            _entries = json.load(f)['entries']
+        for entry in _entries:
+            entry['used'] = False
+        logging.info(f"Replaying {len(_entries)} interactions from {path}")
+
+
+def save():
+    """Write the recorded interactions to the cassette file."""
+    if _mode != 'record':
+        return
+    directory = os.path.dirname(_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with gzip.open(_path, 'wt', encoding='utf-8') as f:
+        json.dump({'version': 2, 'entries': _entries}, f)
+    logging.info(f"Recorded {len(_entries)} interactions to {_path}")
+
+
+def mode():
+    return _mode
+
+
+def _hash_key(key):
+    blob = json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(blob).hexdigest()
+
+
+def url_shape(url):
+    """The URL without its query string or fragment."""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+
+def _take(kind, key, shape):
+    with _lock:
+        fallback = None
+        for entry in _entries:
+            if entry['used'] or entry['kind'] != kind:
+                continue
+            if entry['key'] == key:
+                entry['used'] = True
+                return entry
+            if fallback is None and entry.get('shape') == shape:
+                fallback = entry
+        if fallback is None:
+            raise CassetteMissError(f"No recorded {kind} interaction left to replay for {shape}")
+        logging.warning(
+            f"No exact {kind} match for {shape}, replaying the next recorded call of the same shape")
+        fallback['used'] = True
+        return fallback
+
+
+def call(kind, key, fn, encode=None, decode=None, files=(), shape=None):
+    """
+    Run fn() through the cassette.
+
+    encode/decode convert the result to and from JSON-compatible data, and
+    files lists paths written by fn() that should be captured and restored.
+    shape is a JSON-compatible summary of the call that stays the same
+    when only its details change; a replay without an exact match only
+    falls back to entries of the same shape.
+    Calls made while another recorded call is running are passed through,
+    since replaying the outer call already covers them.
+    """
+    if _mode is None or getattr(_local, 'depth', 0):
+        return fn()
+
+    key = _hash_key(key)
+    if _mode == 'replay':
+        entry = _take(kind, key, shape)
+        for file_path, data in entry['files'].items():
+            directory = os.path.dirname(file_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(file_path, 'wb') as f:
+                f.write(base64.b64decode(data))
+        if _latency == 'original':
+            time.sleep(entry['elapsed'])
+        return decode(entry['result']) if decode else entry['result']
+
+    _local.depth = 1
+    started = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        _local.depth = 0
+    elapsed = time.perf_counter() - started
+
+    captured = {}
+    for file_path in files:
+        if file_path and os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                captured[file_path] = base64.b64encode(f.read()).decode('ascii')
+    with _lock:
+        _entries.append({
+            'kind': kind,
+            'key': key,
+            'shape': shape,
+            'elapsed': elapsed,
+            'result': encode(result) if encode else result,
+            'files': captured,
+        })
+    return result
+
+
+def recorded(kind, encode=None, decode=None, files=None, shape=None):
+    """
+    Decorator form of `call`, keyed on the function's arguments.
+    files, if given, maps the call's arguments to the paths it writes, and
+    shape maps them to the call's shape, which always includes the
+    function name.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            paths = files(*args, **kwargs) if files else ()
+            return call(
+                kind,
+                [args, kwargs],
+                lambda: fn(*args, **kwargs),
+                encode=encode,
+                decode=decode,
+                files=paths,
+                shape=[fn.__name__, shape(*args, **kwargs) if shape else None])
+        return wrapper
+    return decorator
@@ -0,0 +1,123 @@
+"""
+Token-aware compaction of the overview prompt.
+
+The overview prompt embeds the front-page analyses and the traffic
+analysis as HTML. Before it is sent, markup is stripped, stories that
+several papers lead with are kept only once, and each module's section is
+held to a share of a total token budget weighted by its
+`include_in_summary` value.
+"""
+import html
+import math
+import re
+
+
+# Rough size of a token in characters for English prose
+CHARS_PER_TOKEN = 4
+
+BLOCK_TAGS = re.compile(
+    r'</?(?:p|li|ul|ol|h[1-6]|div|br|tr|table|section)\b[^>]*>',
+    re.IGNORECASE)
+TAG = re.compile(r'<[^<]+?>')
+WORD = re.compile(r'[a-z0-9]+')
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def strip_markup(text):
+    """Remove HTML tags and entities, keeping one line per text line."""
+    text = html.unescape(TAG.sub('', text))
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in text.split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def html_blocks(text):
+    """Split HTML into the plain text of its paragraphs, items and headings."""
+    blocks = []
+    for block in BLOCK_TAGS.split(text):
+        block = re.sub(r'\s+', ' ', html.unescape(TAG.sub('', block))).strip()
+        if block:
+            blocks.append(block)
+    return blocks
+
+
+def _shingles(text):
+    words = WORD.findall(text.lower())
+    return {' '.join(words[i:i + 2]) for i in range(max(1, len(words) - 1))}
+
+
+def similarity(a, b):
+    """Jaccard similarity of the word pairs of two texts."""
+    a, b = _shingles(a), _shingles(b)
+    return len(a & b) / len(a | b) if a | b else 0.0
+
+
+def dedupe_blocks(groups, threshold=0.5):
+    """
+    Drop blocks that repeat a block already kept from an earlier group.
+    groups maps a name (e.g. a newspaper) to its list of blocks; blocks are
+    compared by the Jaccard similarity of their word pairs.
+    Returns the filtered groups and the number of blocks dropped.
+    """
+    kept = []
+    result = {}
+    dropped = 0
+    for name, blocks in groups.items():
+        result[name] = []
+        for block in blocks:
+            shingles = _shingles(block)
+            # Short blocks such as headings are too generic to compare
+            if len(shingles) >= 4 and any(
+                    len(shingles & other) / len(shingles | other) >= threshold
+                    for other in kept):
+                dropped += 1
+                continue
+            kept.append(shingles)
+            result[name].append(block)
+    return result, dropped
+
+
+def allocate_budget(sizes, weights, budget):
+    """
+    Split a token budget across sections in proportion to their weights.
+    Sections smaller than their share keep their full size and leave the
+    rest to the others.
+    """
+    allotment = {}
+    pending = {k: v for k, v in sizes.items() if weights.get(k, 0) > 0}
+    remaining = budget
+    while pending:
+        total_weight = sum(weights[k] for k in pending)
+        fits = [k for k in pending
+                if pending[k] <= remaining * weights[k] / total_weight]
+        if not fits:
+            for k in pending:
+                allotment[k] = int(remaining * weights[k] / total_weight)
+            break
+        for k in fits:
+            allotment[k] = pending.pop(k)
+            remaining -= allotment[k]
+    return allotment
+
+
+def truncate_to_tokens(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    if ' ' in cut:
+        cut = cut[:cut.rindex(' ')]
+    return cut.rstrip() + ' ...\n'
+
+
+def compact_sections(sections, weights, budget):
+    """
+    Hold each section to its weighted share of the budget.
+    Returns the compacted sections.
+    """
+    sizes = {k: estimate_tokens(v) for k, v in sections.items()}
+    allotment = allocate_budget(sizes, weights, budget)
+    return {k: truncate_to_tokens(v, allotment.get(k, 0))
+            for k, v in sections.items() if allotment.get(k, 0) > 0}
@@ -4,57 +4,173 @@ from datetime import datetime, timedelta
 from PIL import Image
 import pdf2image
 import base64
+import hashlib
 
+import cassette
+import metrics
 
-def fetch_paper(prefix, offset=0):
+# Long edge in pixels of the JPEG sent to the vision model
+LONG_EDGE = 1568
+# Read size for streaming downloads, hashing and encoding. A multiple of 3
+# so that base64 chunks concatenate without padding.
+CHUNK_SIZE = 3 * 64 * 1024
+
+
+def download_pdf(path_to_pdf, pdf_file):
+    """
+    Stream a PDF to disk. Returns False if it could not be downloaded.
+    """
+    with requests.get(path_to_pdf, stream=True) as response:
+        if response.status_code != 200:
+            return False
+        with open(pdf_file, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                metrics.add_bytes(len(chunk))
+    return True
+
+
+def paper_paths(prefix, offset=0):
+    """
+    Return the PDF URL and the local PDF and JPG paths for a front page.
+    """
     date = datetime.now() - timedelta(days=offset)
     path_to_pdf = f"https://cdn.freedomforum.org/dfp/pdf{date.day}/{prefix}.pdf"
     pdf_file = f"archive/{prefix}_{date.strftime('%Y%m%d')}.pdf"
     jpg_file = f"archive/{prefix}_{date.strftime('%Y%m%d')}.jpg"
-    root_path = os.getcwd() + "/"
+    return path_to_pdf, pdf_file, jpg_file
+
+
+@cassette.recorded(
+    'frontpage',
+    files=lambda prefix, offset=0, *args, **kwargs: [paper_paths(prefix, offset)[2]],
+    shape=lambda prefix, *args, **kwargs: prefix)
+def fetch_paper(prefix, offset=0, low_memory=False):
+    path_to_pdf, pdf_file, jpg_file = paper_paths(prefix, offset)
 
     # Check if JPG already exists
     if not os.path.exists(jpg_file):
         # Try to download PDF
-        response = requests.get(path_to_pdf)
-        if response.status_code == 200:
-            # Save PDF
-            with open(pdf_file, 'wb') as f:
-                f.write(response.content)
+        if not download_pdf(path_to_pdf, pdf_file):
+            return False
 
-            # Convert PDF to JPG
+        # Convert PDF to JPG
+        if low_memory:
+            # Let poppler render straight to the target size instead of
+            # holding a 300 DPI bitmap and resizing it
+            images = pdf2image.convert_from_path(
+                pdf_file, size=LONG_EDGE, first_page=1, last_page=1)
+        else:
             images = pdf2image.convert_from_path(
                 pdf_file, dpi=300, first_page=1, last_page=1)
-            if images:
-                img = images[0]
-                # Resize image to have long edge of 1568 pixels
-                width, height = img.size
-                if width > height:
-                    new_width = 1568
-                    new_height = int(height * (1568 / width))
-                else:
-                    new_height = 1568
-                    new_width = int(width * (1568 / height))
+        if images:
+            img = images[0]
+            # Resize image to have long edge of 1568 pixels
+            width, height = img.size
+            if width > height:
+                new_width = LONG_EDGE
+                new_height = int(height * (LONG_EDGE / width))
+            else:
+                new_height = LONG_EDGE
+                new_width = int(width * (LONG_EDGE / height))
+            if (new_width, new_height) != img.size:
                 img = img.resize((new_width, new_height))
-                img.save(jpg_file, format="JPEG", quality=85)
+            img.save(jpg_file, format="JPEG", quality=85)
+            img.close()
+
+    return jpg_file
 
-            return jpg_file
-    else:
-        return jpg_file
 
-    return False
+def tile_paths(prefix, rows=2, cols=2, overlap=0.1, offset=0):
+    """
+    Return the JPG paths of the tiles of a front page, row by row.
+    The names include the grid and overlap, so tiles cut with other
+    settings are never reused.
+    """
+    jpg_file = paper_paths(prefix, offset)[2]
+    stem = jpg_file[:-len('.jpg')]
+    grid = f"{rows}x{cols}o{round(overlap * 100)}"
+    return [f"{stem}_{grid}_r{row}c{col}.jpg"
+            for row in range(rows) for col in range(cols)]
 
 
-def jpg_to_base64(file_path):
+@cassette.recorded(
+    'frontpage',
+    files=lambda prefix, rows=2, cols=2, overlap=0.1, offset=0: tile_paths(prefix, rows, cols, overlap, offset),
+    shape=lambda prefix, rows=2, cols=2, overlap=0.1, offset=0: [prefix, rows, cols, overlap])
+def fetch_paper_tiles(prefix, rows=2, cols=2, overlap=0.1, offset=0):
     """
-    Load a JPEG file and return its base64-encoded data.
+    Split a front page into rows x cols overlapping tiles, each rendered
+    with a long edge of up to 1568 pixels, so small headlines stay legible.
+    overlap is the fraction of a tile shared with its neighbours.
+    Returns the tile paths, or False if the page could not be fetched.
+    """
+    path_to_pdf, pdf_file, jpg_file = paper_paths(prefix, offset)
+    tiles = tile_paths(prefix, rows, cols, overlap, offset)
+    if all(os.path.exists(tile) for tile in tiles):
+        return tiles
+
+    if not os.path.exists(pdf_file) and not download_pdf(path_to_pdf, pdf_file):
+        return False
+
+    # Render the page large enough for every tile to use the full resolution
+    images = pdf2image.convert_from_path(
+        pdf_file, size=LONG_EDGE * max(rows, cols), first_page=1, last_page=1)
+    if not images:
+        return False
+    img = images[0]
+    width, height = img.size
+    tile_width = width / (cols - (cols - 1) * overlap)
+    tile_height = height / (rows - (rows - 1) * overlap)
+
+    for row in range(rows):
+        for col in range(cols):
+            left = int(col * tile_width * (1 - overlap))
+            top = int(row * tile_height * (1 - overlap))
+            tile = img.crop((
+                left,
+                top,
+                min(width, int(left + tile_width)),
+                min(height, int(top + tile_height))))
+            # Resize tile to have long edge of at most 1568 pixels
+            tile.thumbnail((LONG_EDGE, LONG_EDGE))
+            tile.save(tiles[row * cols + col], format="JPEG", quality=85)
+            tile.close()
+    img.close()
+    return tiles
+
+
+def file_md5(file_path):
+    """
+    Return the MD5 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_to_base64(file_path):
+    """
+    Load a file and return its base64-encoded data, encoding it chunk by
+    chunk so the raw bytes are never held in memory all at once.
     """
     if not os.path.exists(file_path):
         return None
 
-    with open(file_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-    return encoded_string
+    parts = []
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def jpg_to_base64(file_path):
+    """
+    Load a JPEG file and return its base64-encoded data.
+    """
+    return file_to_base64(file_path)
 
 
 if __name__ == "__main__":
@@ -7,19 +7,31 @@ import logging
 import time
 import re
 import random
-import requests
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from PIL import Image
 import io
-import base64
 import traceback
-
-
-from api import generate_anthropic_response, send_email, fetch_crypto_data, get_url, navigate_and_screenshot
-from frontpage import fetch_paper
+import html
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import shutil
+import socket
+import threading
+import multiprocessing
+
+
+from api import generate_anthropic_response, tier_max_tokens, send_email, fetch_crypto_data, get_url, navigate_and_screenshot_many, http_get
+from frontpage import fetch_paper, fetch_paper_tiles, file_md5, file_to_base64
 from weather import extract_weather_info
+import workqueue
+import memory
+import cassette
+import pools
+import metrics
+import compaction
 
 # Set up logging
 parser = argparse.ArgumentParser()
@@ -27,6 +39,46 @@ parser.add_argument(
     '--loglevel',
     default='WARNING',
     help='Set the logging level')
+parser.add_argument(
+    '--enqueue',
+    action='store_true',
+    help='Queue a run of the INCLUDE modules for workers instead of running it inline')
+parser.add_argument(
+    '--worker',
+    action='store_true',
+    help='Process queued units until the queue is drained')
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1,
+    help='Number of local worker processes to start with --worker')
+parser.add_argument(
+    '--follow',
+    action='store_true',
+    help='Keep workers polling for new units instead of exiting when idle')
+parser.add_argument(
+    '--lease',
+    type=int,
+    default=300,
+    help='Lease duration in seconds for claimed units')
+parser.add_argument(
+    '--memory-budget',
+    type=float,
+    default=os.getenv('MEMORY_BUDGET_MB'),
+    help='Run in bounded-memory mode with this budget in MB')
+parser.add_argument(
+    '--record',
+    metavar='CASSETTE',
+    help='Record all external I/O of this run to a cassette file')
+parser.add_argument(
+    '--replay',
+    metavar='CASSETTE',
+    help='Serve all external I/O from a recorded cassette file')
+parser.add_argument(
+    '--replay-latency',
+    choices=['zero', 'original'],
+    default='zero',
+    help='Replay recorded calls instantly or with their original latency')
 args = parser.parse_args()
 log_level = args.loglevel.upper()
 logging.basicConfig(
@@ -36,8 +88,49 @@ logging.basicConfig(
 # Load environment variables
 load_dotenv()
 
-# Set up Jinja2 environment
-template_env = Environment(loader=FileSystemLoader('templates'))
+# Modules that hold decoded images in memory while they run
+IMAGE_MODULES = ('frontpage.yml', 'traffic_analyzer.yml')
+# How many image modules may run at once in bounded-memory mode
+MAX_IMAGE_MODULES = int(os.getenv('MAX_IMAGE_MODULES', 1))
+
+memory.set_budget(args.memory_budget)
+
+# Set up Jinja2 environment, keeping compiled templates across processes
+jinja_cache_dir = os.path.join(os.getenv('CACHE_DIR', 'cache'), 'jinja')
+if not os.path.exists(jinja_cache_dir):
+    os.makedirs(jinja_cache_dir)
+template_env = Environment(
+    loader=FileSystemLoader('templates'),
+    bytecode_cache=FileSystemBytecodeCache(jinja_cache_dir))
+
+# Email sections in display order, each rendered from its own fragment
+EMAIL_SECTIONS = [
+    ('overview', 'fragments/overview.html'),
+    ('weather.yml', 'fragments/weather.html'),
+    ('crypto_price.yml', 'fragments/crypto_price.html'),
+    ('traffic_analyzer.yml', 'fragments/traffic_analyzer.html'),
+    ('frontpage.yml', 'fragments/frontpage.html'),
+    ('word_of_day.yml', 'fragments/word_of_day.html'),
+    ('daily_quote.yml', 'fragments/daily_quote.html'),
+    ('stock_market.yml', 'fragments/stock_market.html'),
+]
+
+# Modules with a dedicated branch in process_module
+MODULE_HANDLERS = (
+    'crypto_price.yml',
+    'frontpage.yml',
+    'weather.yml',
+    'word_of_day.yml',
+    'daily_quote.yml',
+    'traffic_analyzer.yml',
+    'stock_market.yml',
+)
+
+# Rendered fragments by hash of template source and section data, kept in
+# memory only and evicted least recently used first
+FRAGMENT_CACHE_SIZE = 64
+fragment_cache = OrderedDict()
+template_hashes = {}
 
 
 def load_module(module_name):
@@ -50,29 +143,45 @@ def load_module(module_name):
 
 
 def get_cache_path(module_name):
-    cache_dir = "cache"
+    cache_dir = os.getenv('CACHE_DIR', 'cache')
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
     return os.path.join(cache_dir, f"{module_name}_cache.json")
 
 
-def is_cache_valid(cache_path, ttl=None, data_hash=None):
-    if not os.path.exists(cache_path):
-        return False
-    try:
-        print(f"loading {cache_path}")
-        with open(cache_path, "r") as cache_file:
-            cache_data = json.load(cache_file)
-        if data_hash is not None:
-            return data_hash == cache_data['data_hash']
-        else:
-            if ttl is None:
-                return True
-            cache_time = datetime.fromtimestamp(cache_data['timestamp'])
-            return datetime.now() - cache_time < timedelta(seconds=ttl)
-    except Exception as e:
-        print(f"is_cache_valid exception: {e}")
-        return False
+def write_cache(cache_path, data):
+    # Write to a temporary file and rename it into place so that workers
+    # sharing the cache directory never read a half-written entry.
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(data, cache_file)
+    os.replace(tmp_path, cache_path)
+
+
+def is_cache_valid(cache_path, ttl=None, data_hash=None, module=False):
+    """
+    Check a cache file against a TTL or a data hash, and record the lookup
+    as a hit or a miss. module marks the per-module data caches, which are
+    also counted separately.
+    """
+    valid = False
+    if os.path.exists(cache_path):
+        try:
+            print(f"loading {cache_path}")
+            with open(cache_path, "r") as cache_file:
+                cache_data = json.load(cache_file)
+            if data_hash is not None:
+                valid = data_hash == cache_data['data_hash']
+            else:
+                if ttl is None:
+                    valid = True
+                else:
+                    cache_time = datetime.fromtimestamp(cache_data['timestamp'])
+                    valid = datetime.now() - cache_time < timedelta(seconds=ttl)
+        except Exception as e:
+            print(f"is_cache_valid exception: {e}")
+    metrics.record_cache(valid, module=module)
+    return valid
 
 
 def process_module(module_name, config):
@@ -82,27 +191,45 @@ def process_module(module_name, config):
     common['include_in_summary'] = config.get('include_in_summary', False)
 
     if module_name == 'crypto_price.yml':
-        cache_path = get_cache_path(module_name)
         # Default TTL of 1 hour if not specified
         ttl = config.get('cache_ttl', 3600)
 
-        if is_cache_valid(cache_path, ttl):
-            with open(cache_path, 'r') as cache_file:
-                return json.load(cache_file)['data']
-
         crypto_ids = config.get('crypto_ids', [])
         currency = config.get('currency', 'usd')
         options = config.get('options', {})
 
-        # Fetch crypto data with specified options
-        crypto_data = fetch_crypto_data(
-            crypto_ids,
-            vs_currency=currency,
-            order='market_cap_desc',
-            per_page=options.get(
-                'max_coins',
-                100),
-            price_change_percentage='24h' if options.get('include_24h_change') else None)
+        # Coins are cached individually so that only expired ones are fetched
+        cache_path = get_cache_path(f"crypto_{currency}_coins")
+        coins = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                coins = json.load(cache_file)['coins']
+        now = time.time()
+        expired = [crypto_id for crypto_id in crypto_ids
+                   if crypto_id not in coins or now - coins[crypto_id]['timestamp'] >= ttl]
+        metrics.record_cache(not expired, module=True)
+
+        if expired:
+            # Fetch crypto data with specified options
+            fetched = fetch_crypto_data(
+                expired,
+                vs_currency=currency,
+                order='market_cap_desc',
+                per_page=None,
+                price_change_percentage='24h' if options.get('include_24h_change') else None,
+                requests_per_minute=options.get('requests_per_minute', 30))
+            for crypto in fetched:
+                coins[crypto['id']] = {'timestamp': now, 'data': crypto}
+            missing = set(expired) - {crypto['id'] for crypto in fetched}
+            if missing:
+                logging.warning(
+                    f"No fresh data for {len(missing)} coins, using cached entries where available: {sorted(missing)}")
+            write_cache(cache_path, {'coins': coins})
+
+        crypto_data = sorted(
+            [coins[crypto_id]['data'] for crypto_id in dict.fromkeys(crypto_ids) if crypto_id in coins],
+            key=lambda crypto: crypto.get('market_cap') or 0,
+            reverse=True)[:options.get('max_coins', 100)]
 
         # Filter and format the data based on options
         formatted_data = {}
@@ -120,32 +247,32 @@ def process_module(module_name, config):
             crypto_list.append(crypto_info)
         formatted_data['crypto_list'] = crypto_list
 
-        # Cache the new data
         formatted_data.update(common)
-        cache_data = {
-            'timestamp': time.time(),
-            'data': formatted_data
-        }
-        with open(cache_path, 'w') as cache_file:
-            json.dump(cache_data, cache_file)
-
         return formatted_data
 
     elif module_name == 'frontpage.yml':
         newspapers = config.get('newspapers', [])
+        tiling = config.get('tiling', {})
         frontpages = {}
         for prefix in newspapers:
-            result = fetch_paper(prefix)
-            if result:
-                with open(result, 'rb') as f:
-                    frontpage_data = f.read()
+            if tiling.get('enabled'):
+                analysis = analyze_frontpage_tiles(prefix, tiling)
+                if analysis:
+                    frontpages[prefix] = {
+                        'date': datetime.now().strftime('%Y-%m-%d'),
+                        'analysis': analysis
+                    }
+                    continue
+                logging.warning(f"Tiled analysis of {prefix} found no stories, analyzing the whole page")
 
+            result = fetch_paper(prefix, low_memory=memory.is_bounded())
+            if result:
                 # Generate a hash of the image data
-                data_hash = hashlib.md5(frontpage_data).hexdigest()
+                data_hash = file_md5(result)
                 cache_path = get_cache_path(prefix)
 
                 # Check if we have a cached analysis
-                if is_cache_valid(cache_path, data_hash=data_hash):
+                if is_cache_valid(cache_path, data_hash=data_hash, module=True):
                     with open(cache_path, 'r') as cache_file:
                         data = json.load(cache_file)
                 else:
@@ -174,7 +301,7 @@ Please ensure your response is concise, informative, and uses proper HTML format
                                   'source': {
                                       'type': 'base64',
                                       'media_type': 'image/jpeg',
-                                      'data': base64.b64encode(frontpage_data).decode('ascii'),
+                                      'data': file_to_base64(result),
                                   }
                               },
                               {
@@ -182,7 +309,9 @@ Please ensure your response is concise, informative, and uses proper HTML format
                                   'text': prompt,
                               },
                           ]
-                          }])
+                          }],
+                        tier='vision',
+                        max_tokens=1500)
 
                     analysis = response[0].text
 
@@ -191,8 +320,7 @@ Please ensure your response is concise, informative, and uses proper HTML format
                         'data_hash': data_hash,
                         'analysis': analysis,
                     }
-                    with open(cache_path, 'w') as cache_file:
-                        json.dump(data, cache_file)
+                    write_cache(cache_path, data)
 
                 frontpages[prefix] = {
                     'date': datetime.now().strftime('%Y-%m-%d'),
@@ -207,7 +335,7 @@ Please ensure your response is concise, informative, and uses proper HTML format
         # Default TTL of 1 hour if not specified
         ttl = config.get('cache_duration', 3600)
 
-        if is_cache_valid(cache_path, ttl):
+        if is_cache_valid(cache_path, ttl, module=True):
             with open(cache_path, 'r') as cache_file:
                 return json.load(cache_file)['data']
 
@@ -241,26 +369,37 @@ Please ensure your response is concise, informative, and uses proper HTML format
             'timestamp': time.time(),
             'data': weather_results
         }
-        with open(cache_path, 'w') as cache_file:
-            json.dump(cache_data, cache_file)
+        write_cache(cache_path, cache_data)
 
         return weather_results
 
     elif module_name == 'word_of_day.yml':
+        # Pick from the prefetched local pool when it has been filled. The
+        # pick is a local lookup that is stable for the day, so it is not
+        # cached; the TTL cache only covers the live API.
+        pool_config = config.get('pool', {})
+        word_data = pools.select(
+            pools.WORD_POOL, window_days=pool_config.get('window_days', 365))
+        if word_data:
+            word_data.update(common)
+            return word_data
+
         cache_path = get_cache_path(module_name)
         ttl = config.get('cache_duration', 86400)  # Default TTL of 24 hours
 
-        if is_cache_valid(cache_path, ttl):
+        if is_cache_valid(cache_path, ttl, module=True):
             with open(cache_path, 'r') as cache_file:
                 return json.load(cache_file)['data']
 
+        logging.warning(
+            "Word pool is empty, run `python pools.py --prefetch words`")
         api_url = config['api']['url']
 
         # Get a random word from a predefined list or another source
         word = random.choice(
             ['serendipity', 'ephemeral', 'eloquent', 'resilient', 'innovative'])
 
-        response = requests.get(f"{api_url}{word}")
+        response = http_get(f"{api_url}{word}")
         if response.status_code == 200:
             data = response.json()[0]
             word_data = {
@@ -275,8 +414,7 @@ Please ensure your response is concise, informative, and uses proper HTML format
                 'timestamp': time.time(),
                 'data': word_data
             }
-            with open(cache_path, 'w') as cache_file:
-                json.dump(cache_data, cache_file)
+            write_cache(cache_path, cache_data)
 
             word_data.update(common)
             return word_data
@@ -286,16 +424,26 @@ Please ensure your response is concise, informative, and uses proper HTML format
             return None
 
     elif module_name == 'daily_quote.yml':
+        # Pick from the prefetched local pool when it has been filled; as
+        # for the word of the day, only the live API is cached
+        pool_config = config.get('pool', {})
+        quote_data = pools.select(
+            pools.QUOTE_POOL, window_days=pool_config.get('window_days', 365))
+        if quote_data:
+            return quote_data
+
         cache_path = get_cache_path(module_name)
         ttl = config.get('cache_duration', 86400)  # Default TTL of 24 hours
 
-        if is_cache_valid(cache_path, ttl):
+        if is_cache_valid(cache_path, ttl, module=True):
             with open(cache_path, 'r') as cache_file:
                 return json.load(cache_file)['data']
 
+        logging.warning(
+            "Quote pool is empty, run `python pools.py --prefetch quotes`")
         api_url = config['api']['url']
 
-        response = requests.get(api_url)
+        response = http_get(api_url)
         if response.status_code == 200:
             data = response.json()
             quote_data = {
@@ -308,8 +456,7 @@ Please ensure your response is concise, informative, and uses proper HTML format
                 'timestamp': time.time(),
                 'data': quote_data
             }
-            with open(cache_path, 'w') as cache_file:
-                json.dump(cache_data, cache_file)
+            write_cache(cache_path, cache_data)
 
             return quote_data
         else:
@@ -319,109 +466,59 @@ Please ensure your response is concise, informative, and uses proper HTML format
 
     elif module_name == 'traffic_analyzer.yml':
         options = config.get('options', {})
+        dow = datetime.now().isoweekday()
+
+        # Routes not scheduled for today are skipped
+        routes = []
+        for route in traffic_routes(config):
+            days_to_run = route.get('days_to_run', options.get('days_to_run'))
+            if days_to_run is not None and dow not in days_to_run:
+                logging.info(f"dow: {dow} not in days_to_run: {days_to_run} for {route['name']}")
+                continue
+            routes.append(route)
+        if not routes:
+            return None
 
-        if "days_to_run" in options:
-            days_to_run = options["days_to_run"]
-            dow = datetime.now().weekday()
-            if dow not in days_to_run:
-                logging.info(f"dow: {dow} not in days_to_run: {days_to_run}")
-                return None
-
-        cache_path = get_cache_path(module_name)
         ttl = config.get('cache_duration', 1800)  # Default TTL of 30 minutes
 
-        if is_cache_valid(cache_path, ttl):
-            with open(cache_path, 'r') as cache_file:
-                return json.load(cache_file)['data']
-
-        maps_url = config['maps_url']
-        route_description = config['route_description']
-        screenshot_config = config['screenshot']
-
-        # Take screenshot
-        screenshot_path = screenshot_config['filename']
-        navigate_and_screenshot(
-            maps_url,
-            screenshot_path,
-            screenshot_config['width'],
-            screenshot_config['height'])
-
-        # Analyze screenshot with Claude
-        with open(screenshot_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('ascii')
-
-        prompt = f"""You will be analyzing a traffic map based on a provided description. Your task is to provide a concise summary of the current traffic conditions, estimated travel time, and any notable delays or incidents.
-
-<route_description>
-{route_description}
-</route_description>
-
-Here's how to proceed:
-
-1. Analyze the information provided in the image description. Pay attention to:
-   - Overall traffic flow
-   - Areas of congestion
-   - Reported incidents or accidents
-   - Estimated travel times for major routes
-
-2. Formulate a concise summary of the traffic conditions. Your summary should include:
-   - A general overview of the traffic situation
-   - Specific areas experiencing heavy traffic or delays
-   - Any notable incidents or accidents affecting traffic flow
-   - Estimated travel times for key routes, if available
-
-3. Format your response in HTML. Use appropriate HTML tags to structure your summary. For example:
-   - Use <h2> for main section headings
-   - Use <p> for paragraphs
-   - Use <ul> or <ol> for lists of incidents or affected areas
-   - Use <strong> to emphasize important information
-
-4. Your response should be informative and easy to read. Focus on providing actionable information for drivers.
-
-5. Do not describe the image itself or mention that you're analyzing an image description. Present the information as if you're a traffic reporter providing real-time updates.
+        route_data = {}
+        stale = []
+        for route in routes:
+            cache_path = get_cache_path(f"traffic_{route['key']}")
+            if is_cache_valid(cache_path, ttl, module=True):
+                with open(cache_path, 'r') as cache_file:
+                    route_data[route['key']] = json.load(cache_file)['data']
+            else:
+                stale.append(route)
 
-Remember to provide a concise yet comprehensive summary of the traffic conditions based solely on the information given in the image description."""
+        if stale:
+            analyses = analyze_traffic_routes(stale, config['screenshot'])
+            for route in stale:
+                if route['key'] not in analyses:
+                    continue
+                # Cache the analysis
+                data = {
+                    'name': route['name'],
+                    'analysis': analyses[route['key']],
+                    'maps_url': route['maps_url']
+                }
+                cache_data = {
+                    'timestamp': time.time(),
+                    'data': data,
+                }
+                write_cache(get_cache_path(f"traffic_{route['key']}"), cache_data)
+                route_data[route['key']] = data
 
-        response = generate_anthropic_response(
-            [{'role': 'user',
-              'content': [
-                  {
-                      'type': 'image',
-                      'source': {
-                          'type': 'base64',
-                          'media_type': 'image/png',
-                          'data': image_data,
-                      }
-                  },
-                  {
-                      'type': 'text',
-                      'text': prompt,
-                  },
-              ]
-              }])
-
-        traffic_analysis = response[0].text
-
-        # Cache the analysis
-        data = {
-            'analysis': traffic_analysis,
-            'maps_url': maps_url
-        }
+        data = {'routes': [route_data[route['key']]
+                           for route in routes if route['key'] in route_data]}
         data.update(common)
-        cache_data = {
-            'timestamp': time.time(),
-            'data': data,
-        }
-        with open(cache_path, 'w') as cache_file:
-            json.dump(cache_data, cache_file)
-
         return data
 
     elif module_name == 'stock_market.yml':
         cache_path = get_cache_path(module_name)
         ttl = config.get('cache_duration', 3600)  # Default TTL of 1 hour
 
-        if is_cache_valid(cache_path, ttl):
+        if is_cache_valid(cache_path, ttl, module=True):
             with open(cache_path, 'r') as cache_file:
                 return json.load(cache_file)['data']
 
@@ -436,7 +533,7 @@ Remember to provide a concise yet comprehensive summary of the traffic condition
                 'symbol': symbol,
                 'apikey': api_key
             }
-            response = requests.get(api_url, params=params)
+            response = http_get(api_url, params=params)
             if response.status_code == 200:
                 print(response.json())
                 data = response.json()['Global Quote']
@@ -455,8 +552,7 @@ Remember to provide a concise yet comprehensive summary of the traffic condition
                 'timestamp': time.time(),
                 'data': stock_data
             }
-            with open(cache_path, 'w') as cache_file:
-                json.dump(cache_data, cache_file)
+            write_cache(cache_path, cache_data)
 
             stock_data.update(common)
             return stock_data
@@ -466,33 +562,459 @@ Remember to provide a concise yet comprehensive summary of the traffic condition
 
     else:
         # For other modules, you might use Claude to process the data
-        module_data = f"Data for {module_name}: {config}"
-        prompt = f"Please summarize the following data for the daily brief: {module_data}"
-        response = generate_anthropic_response(
-            [{"role": "user", "content": prompt}])
-        data = {'text': response[0].text}
-        data.update(common)
-        return data
+        return process_generic_modules({module_name: config})[module_name]
+
+
+def extract_json(text):
+    """Parse the outermost JSON object in a model response."""
+    return json.loads(text[text.index('{'):text.rindex('}') + 1])
+
+
+FRONTPAGE_TILE_PROMPT = """This image is one section of a newspaper front page: row {row} of {rows}, column {col} of {cols}. Neighbouring sections overlap slightly, so stories at the edges may be cut off.
+
+List every news story whose headline is readable in this section, including small items below the fold. Respond with a single JSON object and no other text, in this form:
+
+{{"stories": [{{"headline": "...", "summary": "One or two sentences on the story and its significance.", "prominence": 3}}], "themes": ["..."]}}
+
+prominence runs from 1 (minor item) to 5 (the page's lead story), judged by headline size and placement. themes lists any overarching themes or trends visible in this section."""
+
+
+def analyze_frontpage_tile(tile, row, rows, col, cols):
+    prompt = FRONTPAGE_TILE_PROMPT.format(
+        row=row + 1, rows=rows, col=col + 1, cols=cols)
+    response = generate_anthropic_response(
+        [{'role': 'user',
+          'content': [
+              {
+                  'type': 'image',
+                  'source': {
+                      'type': 'base64',
+                      'media_type': 'image/jpeg',
+                      'data': file_to_base64(tile),
+                  }
+              },
+              {
+                  'type': 'text',
+                  'text': prompt,
+              },
+          ]
+          }],
+        tier='vision',
+        max_tokens=1500)
+    try:
+        return extract_json(response[0].text)
+    except ValueError:
+        logging.error(f"Could not parse analysis of {tile}: {response[0].text[:200]}")
+        return {}
+
+
+def story_prominence(value):
+    """Coerce a story's prominence to an int from 1 to 5, defaulting to 1."""
+    try:
+        return min(5, max(1, int(float(value))))
+    except (TypeError, ValueError, OverflowError):
+        return 1
+
+
+def merge_tile_analyses(results):
+    """
+    Merge per-tile stories into the HTML layout of a whole-page analysis,
+    keeping one copy of stories that appear in overlapping tiles.
+    """
+    stories = []
+    themes = []
+    for result in results:
+        # Tile replies are model output, so any field may have an unexpected type
+        if not isinstance(result, dict):
+            continue
+        for story in result.get('stories') or []:
+            if not isinstance(story, dict):
+                continue
+            headline = str(story.get('headline') or '').strip()
+            if not headline:
+                continue
+            story = {
+                'headline': headline,
+                'summary': str(story.get('summary') or '').strip(),
+                'prominence': story_prominence(story.get('prominence')),
+            }
+            duplicate = next(
+                (kept for kept in stories
+                 if compaction.similarity(kept['headline'], headline) >= 0.5
+                 or compaction.similarity(
+                     f"{kept['headline']} {kept['summary']}",
+                     f"{headline} {story['summary']}") >= 0.5),
+                None)
+            if duplicate is None:
+                stories.append(story)
+            elif (story['prominence'], len(story['summary'])) > (duplicate['prominence'], len(duplicate['summary'])):
+                duplicate.update(story)
+        for theme in result.get('themes') or []:
+            if not isinstance(theme, str) or not theme.strip():
+                continue
+            theme = theme.strip()
+            if not any(compaction.similarity(theme, kept) >= 0.5 for kept in themes):
+                themes.append(theme)
+
+    if not stories:
+        return None
+    stories.sort(key=lambda story: -story['prominence'])
+    top, others = stories[0], stories[1:]
+    analysis = "<h4>Top Story</h4>\n"
+    analysis += f"<p><strong>{html.escape(top['headline'])}</strong>: {html.escape(top['summary'])}</p>\n"
+    if others:
+        analysis += "\n<h4>Other Major Headlines</h4>\n<ul>\n"
+        for story in others:
+            analysis += f"  <li><strong>{html.escape(story['headline'])}:</strong> {html.escape(story['summary'])}</li>\n"
+        analysis += "</ul>\n"
+    if themes:
+        analysis += "\n<h4>Notable Trends or Themes</h4>\n"
+        analysis += f"<p>{html.escape(' '.join(themes))}</p>\n"
+    return analysis
+
+
+def analyze_frontpage_tiles(prefix, tiling):
+    """
+    Analyze a front page as overlapping high-resolution tiles, calling
+    Claude for all tiles concurrently, and merge the results.
+    """
+    rows = tiling.get('rows', 2)
+    cols = tiling.get('cols', 2)
+    tiles = fetch_paper_tiles(prefix, rows, cols, tiling.get('overlap', 0.1))
+    if not tiles:
+        return None
+
+    # Generate a hash of the tile images and the tiling settings
+    data_hash = hashlib.md5(json.dumps(
+        [[file_md5(tile) for tile in tiles], tiling], sort_keys=True).encode('utf-8')).hexdigest()
+    cache_path = get_cache_path(f"{prefix}_tiles")
+    if is_cache_valid(cache_path, data_hash=data_hash, module=True):
+        with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)['analysis']
+
+    with ThreadPoolExecutor(max_workers=len(tiles)) as executor:
+        results = list(executor.map(
+            lambda index: analyze_frontpage_tile(
+                tiles[index], index // cols, rows, index % cols, cols),
+            range(len(tiles))))
+
+    analysis = merge_tile_analyses(results)
+    if analysis:
+        write_cache(cache_path, {
+            'data_hash': data_hash,
+            'analysis': analysis,
+        })
+    return analysis
+
+
+# Output budget per traffic route and per generic module summary; batched
+# requests get one budget per item
+TRAFFIC_ANALYSIS_TOKENS = 1024
+GENERIC_SUMMARY_TOKENS = 512
+
+TRAFFIC_PROMPT = """You will be analyzing a traffic map based on a provided description. Your task is to provide a concise summary of the current traffic conditions, estimated travel time, and any notable delays or incidents.
+
+<route_description>
+{route_description}
+</route_description>
+
+Here's how to proceed:
+
+1. Analyze the information provided in the image description. Pay attention to:
+   - Overall traffic flow
+   - Areas of congestion
+   - Reported incidents or accidents
+   - Estimated travel times for major routes
+
+2. Formulate a concise summary of the traffic conditions. Your summary should include:
+   - A general overview of the traffic situation
+   - Specific areas experiencing heavy traffic or delays
+   - Any notable incidents or accidents affecting traffic flow
+   - Estimated travel times for key routes, if available
+
+3. Format your response in HTML. Use appropriate HTML tags to structure your summary. For example:
+   - Use <h2> for main section headings
+   - Use <p> for paragraphs
+   - Use <ul> or <ol> for lists of incidents or affected areas
+   - Use <strong> to emphasize important information
+
+4. Your response should be informative and easy to read. Focus on providing actionable information for drivers.
+
+5. Do not describe the image itself or mention that you're analyzing an image description. Present the information as if you're a traffic reporter providing real-time updates.
+
+Remember to provide a concise yet comprehensive summary of the traffic conditions based solely on the information given in the image description."""
+
+TRAFFIC_ROUTES_PROMPT = """You will be analyzing traffic maps for several routes. Each map image above is preceded by the key and description of its route. For each route, provide a concise summary of the current traffic conditions, estimated travel time, and any notable delays or incidents.
+
+Each route's summary should include:
+   - A general overview of the traffic situation
+   - Specific areas experiencing heavy traffic or delays
+   - Any notable incidents or accidents affecting traffic flow
+   - Estimated travel times for key routes, if available
+
+Format each summary in HTML. Start it with an <h2> heading naming the route, and use <p>, <ul> or <ol>, and <strong> for the rest. Focus on providing actionable information for drivers, and do not describe the images themselves; present the information as if you're a traffic reporter providing real-time updates.
+
+Respond with a single JSON object and no other text, mapping each route key to its HTML summary, for example: {{"route_key": "<h2>...</h2><p>...</p>"}}"""
+
+
+def traffic_routes(config):
+    """
+    Return the routes of a traffic config, each with a name, maps_url,
+    route_description and a key used for its cache entry and screenshot.
+    Keys are made from the names and numbered when they would collide.
+    A config with a single top-level maps_url is treated as one route.
+    """
+    routes = config.get('routes')
+    if routes is None:
+        routes = [{
+            'name': config['route_description'],
+            'maps_url': config['maps_url'],
+            'route_description': config['route_description'],
+        }]
+    result = []
+    keys = set()
+    for index, route in enumerate(routes, 1):
+        route = dict(route)
+        route.setdefault('name', route.get('route_description', route['maps_url']))
+        route.setdefault('route_description', route['name'])
+        key = re.sub(r'[^a-z0-9]+', '_', route['name'].lower()).strip('_') or 'route'
+        if key in keys:
+            key = f"{key}_{index}"
+        if key in keys:
+            raise ValueError(f"Traffic route {route['name']} has a duplicate key {key}")
+        keys.add(key)
+        route['key'] = key
+        result.append(route)
+    return result
+
+
+def analyze_traffic_route(route, screenshot_path):
+    prompt = TRAFFIC_PROMPT.format(route_description=route['route_description'])
+    response = generate_anthropic_response(
+        [{'role': 'user',
+          'content': [
+              {
+                  'type': 'image',
+                  'source': {
+                      'type': 'base64',
+                      'media_type': 'image/png',
+                      'data': file_to_base64(screenshot_path),
+                  }
+              },
+              {
+                  'type': 'text',
+                  'text': prompt,
+              },
+          ]
+          }],
+        tier='vision',
+        max_tokens=TRAFFIC_ANALYSIS_TOKENS)
+    return response[0].text
+
+
+def split_for_tier(items, tier, tokens_per_item):
+    """
+    Split items into batches whose combined output budget fits within the
+    tier's max_tokens, so that batched JSON replies are not cut off.
+    """
+    size = max(1, tier_max_tokens(tier) // tokens_per_item)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def analyze_traffic_routes(routes, screenshot_config):
+    """
+    Screenshot every route in parallel tabs of one browser and analyze the
+    screenshots in as few Claude requests as the vision tier's output
+    limit allows. Returns {route key: analysis}.
+    """
+    stem, extension = os.path.splitext(screenshot_config['filename'])
+    screenshots = {route['key']: f"{stem}_{route['key']}{extension}"
+                   for route in routes}
+    captured = navigate_and_screenshot_many(
+        [(route['maps_url'], screenshots[route['key']]) for route in routes],
+        screenshot_config['width'],
+        screenshot_config['height'])
+    routes = [route for route, ok in zip(routes, captured) if ok]
+
+    analyses = {}
+    for batch in split_for_tier(routes, 'vision', TRAFFIC_ANALYSIS_TOKENS):
+        analyses.update(analyze_traffic_batch(batch, screenshots))
+    return analyses
+
+
+def analyze_traffic_batch(routes, screenshots):
+    if len(routes) == 1:
+        route = routes[0]
+        return {route['key']: analyze_traffic_route(route, screenshots[route['key']])}
+
+    content = []
+    for route in routes:
+        content.append({
+            'type': 'text',
+            'text': f"Route key: {route['key']}\nRoute description: {route['route_description']}",
+        })
+        content.append({
+            'type': 'image',
+            'source': {
+                'type': 'base64',
+                'media_type': 'image/png',
+                'data': file_to_base64(screenshots[route['key']]),
+            }
+        })
+    content.append({'type': 'text', 'text': TRAFFIC_ROUTES_PROMPT})
+    response = generate_anthropic_response(
+        [{'role': 'user', 'content': content}],
+        tier='vision',
+        max_tokens=TRAFFIC_ANALYSIS_TOKENS * len(routes))
+
+    try:
+        analyses = extract_json(response[0].text)
+    except ValueError:
+        logging.error(f"Could not parse multi-route traffic analysis: {response[0].text[:200]}")
+        analyses = {}
+    for route in routes:
+        if not isinstance(analyses.get(route['key']), str):
+            logging.warning(f"No traffic analysis for {route['name']}, analyzing it alone")
+            analyses[route['key']] = analyze_traffic_route(route, screenshots[route['key']])
+    return analyses
+
+
+def summarize_generic_module(module_name, config):
+    module_data = f"Data for {module_name}: {config}"
+    prompt = f"Please summarize the following data for the daily brief: {module_data}"
+    response = generate_anthropic_response(
+        [{"role": "user", "content": prompt}],
+        tier='light',
+        max_tokens=GENERIC_SUMMARY_TOKENS)
+    return response[0].text
+
+
+def summarize_generic_batch(configs):
+    """Summarize a batch of generic modules in one Claude request."""
+    if len(configs) == 1:
+        module_name, config = next(iter(configs.items()))
+        return {module_name: summarize_generic_module(module_name, config)}
+
+    modules = "\n".join(
+        f'<module key="{module_name}">\n{config}\n</module>'
+        for module_name, config in configs.items())
+    prompt = f"""Please summarize the following data for the daily brief. Each module's data is enclosed in a <module> tag with a unique key.
+
+{modules}
+
+Respond with a single JSON object that maps each module key to its summary as a string, with no other text. For example: {{"example.yml": "Summary of the example data."}}"""
+    response = generate_anthropic_response(
+        [{"role": "user", "content": prompt}],
+        tier='light',
+        max_tokens=GENERIC_SUMMARY_TOKENS * len(configs))
+    text = response[0].text
+    try:
+        summaries = extract_json(text)
+    except ValueError:
+        logging.error(f"Could not parse batched module summaries: {text[:200]}")
+        summaries = {}
+    for module_name, config in configs.items():
+        if not isinstance(summaries.get(module_name), str):
+            logging.warning(f"No batched summary for {module_name}, summarizing it alone")
+            summaries[module_name] = summarize_generic_module(module_name, config)
+    return summaries
+
+
+def process_generic_modules(configs):
+    """
+    Summarize modules without a dedicated handler in as few Claude
+    requests as the light tier's output limit allows. configs maps module
+    names to their configs; the summaries are cached in one file that is
+    valid while the hash of the configs matches. Returns {module name: data}.
+    """
+    data_hash = hashlib.md5(
+        json.dumps(configs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    cache_path = get_cache_path("generic_modules")
+
+    if is_cache_valid(cache_path, data_hash=data_hash):
+        with open(cache_path, 'r') as cache_file:
+            summaries = json.load(cache_file)['summaries']
+    else:
+        summaries = {}
+        for batch in split_for_tier(list(configs), 'light', GENERIC_SUMMARY_TOKENS):
+            summaries.update(summarize_generic_batch({name: configs[name] for name in batch}))
+        write_cache(cache_path, {'data_hash': data_hash, 'summaries': summaries})
+
+    results = {}
+    for module_name, config in configs.items():
+        data = {'text': summaries[module_name]}
+        data['include_in_summary'] = config.get('include_in_summary', False)
+        results[module_name] = data
+    return results
 
 
 def generate_report(modules):
     report_data = {}
+    configs = {}
     for module in modules:
         config = load_module(module)
         if config:
-            module_data = process_module(module, config)
+            configs[module] = config
+
+    # Modules without a handler are summarized together in one request
+    generic = {module: config for module, config in configs.items()
+               if module not in MODULE_HANDLERS}
+    if generic:
+        started = time.perf_counter()
+        generic_data = process_generic_modules(generic)
+        metrics.record_module(
+            'generic modules', time.perf_counter() - started)
+
+    for module, config in configs.items():
+        if module in generic:
+            report_data[module] = generic_data[module]
+        else:
+            started = time.perf_counter()
+            peak_rss_mb = None
+            if memory.is_bounded():
+                with memory.track_peak_rss(module) as rss:
+                    module_data = process_module(module, config)
+                peak_rss_mb = rss['peak_mb']
+            else:
+                module_data = process_module(module, config)
+            metrics.record_module(
+                module, time.perf_counter() - started, peak_rss_mb)
             report_data[module] = module_data
     return report_data
 
 
+def render_fragment(section, template_name, data):
+    if template_name not in template_hashes:
+        source = template_env.loader.get_source(template_env, template_name)[0]
+        template_hashes[template_name] = hashlib.md5(source.encode('utf-8')).hexdigest()
+    source_hash = template_hashes[template_name]
+    data_hash = hashlib.md5(
+        json.dumps([template_name, source_hash, data], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    if data_hash in fragment_cache:
+        fragment_cache.move_to_end(data_hash)
+        return fragment_cache[data_hash]
+
+    template = template_env.get_template(template_name)
+    fragment = template.render({'report_data': {section: data}})
+    fragment_cache[data_hash] = fragment
+    if len(fragment_cache) > FRAGMENT_CACHE_SIZE:
+        fragment_cache.popitem(last=False)
+    return fragment
+
+
 def create_email_body(report_data):
     template = template_env.get_template('email_template.html')
     try:
         current_datetime = datetime.now()
+        # Only sections whose data changed are rendered again
+        fragments = [
+            render_fragment(section, template_name, report_data[section])
+            for section, template_name in EMAIL_SECTIONS
+            if report_data.get(section)]
         context = {
             'date': current_datetime.strftime('%A, %b %d, %Y'),
             'time': current_datetime.strftime('%H:%M:%S'),
-            'report_data': report_data
+            'fragments': fragments
         }
         email_body = template.render(context)
         logging.info(f"Email body created, length: {len(email_body)}")
@@ -506,81 +1028,379 @@ def create_email_body(report_data):
         raise
 
 
-def generate_overview(report_data):
-    # Prepare a summary of the report data
-    summary = "Today's report includes:\n"
+OVERVIEW_PROMPT = """Create a concise overview of today's report, highlighting the most important points and any notable trends. The overview should be engaging, informative, and action-oriented, suitable as the opening of a daily brief email for busy professionals.
+
+Start the overview directly with the content, without any introductory phrases. The tone should be professional and insightful. Focus on providing key takeaways that the reader can use to inform their day.
+
+Limit the overview to 1-3 paragraphs. Avoid broad generalizations or philosophical musings about the interconnectedness of events. Instead, concentrate on specific, important information and its potential impact on the reader's day or decisions.
+
+Summary of report contents:
+{summary}
+
+Format your response in HTML, using appropriate tags for structure and emphasis."""
 
+OVERVIEW_UPDATE_PROMPT = """Below is the overview that opens today's daily brief email, followed by the sections of the report that have changed since it was written. Revise the overview so that it reflects the changes. Keep everything that is still accurate as it is, including its structure, tone and length (1-3 paragraphs), and only rewrite what the changes affect.
+
+<previous_overview>
+{overview}
+</previous_overview>
+
+<changed_sections>
+{changes}
+</changed_sections>
+
+Respond with the complete revised overview only, formatted in HTML like the previous one."""
+
+# Reuse a stored overview for at most this many seconds
+OVERVIEW_MAX_AGE = int(os.getenv('OVERVIEW_MAX_AGE', 86400))
+# Regenerate from scratch when more than this share of sections changed
+OVERVIEW_UPDATE_FRACTION = float(os.getenv('OVERVIEW_UPDATE_FRACTION', 0.5))
+# Estimated input tokens allowed for the report sections of the prompt
+OVERVIEW_TOKEN_BUDGET = int(os.getenv('OVERVIEW_TOKEN_BUDGET', 2000))
+
+
+def summarize_section(config, data):
+    summary = ""
+    if config == 'weather.yml':
+        weather_data = data
+        location = weather_data.get(
+            'location_name', 'the specified location')
+        summary += f"- Weather information for {location}\n"
+
+        if 'hazards' in weather_data and weather_data['hazards']:
+            hazards = [re.sub('<[^<]+?>', '', hazard)
+                       for hazard in weather_data['hazards']]
+            summary += f"  - Hazardous conditions: {', '.join(hazards)}\n"
+
+        if 'detailed_forecast' in weather_data:
+            today_forecast = next(
+                iter(
+                    weather_data['detailed_forecast'].values()),
+                "No forecast available")
+            today_forecast = re.sub(
+                '<[^<]+?>', '', today_forecast)  # Remove HTML tags
+            summary += f"  - Today's forecast: {today_forecast}\n"
+    elif config == 'crypto_price.yml':
+        crypto_summary = ", ".join(
+            [f"{c['name']}: ${c['current_price']:.2f} price_change_24h: {c['price_change_24h']}" for c in data['crypto_list']])
+        summary += f"- Cryptocurrency prices (including {crypto_summary})\n"
+    elif config == 'frontpage.yml':
+        newspapers = ", ".join([paper for paper in data.keys(
+        ) if paper != 'include_in_summary'])
+        summary += f"- Front page news analysis from {newspapers}\n"
+        for paper in data:
+            if paper == 'include_in_summary':
+                continue
+            summary += f"  - {paper}: {data[paper]}\n"
+    elif config == 'stock_market.yml':
+        stock_summary = ", ".join(
+            [f"{symbol}: {stock['change_percent']}" for symbol, stock in data.items() if symbol != 'include_in_summary'])
+        summary += f"- Stock market summary ({stock_summary})\n"
+    elif config == 'word_of_day.yml':
+        summary += f"- Word of the Day: {data['word']}\n"
+    elif config == 'daily_quote.yml':
+        summary += f"- Daily Quote by {data['author']}\n"
+    elif config == 'traffic_analyzer.yml':
+        for route in data.get('routes', [data]):
+            summary += f"- Traffic analysis for {route.get('name', 'your route')}: {route['analysis']}\n"
+    else:
+        summary += f"- Unnamed data {data}\n"
+    return summary
+
+
+def summary_inputs(report_data):
+    inputs = {}
     for config in report_data:
-        if report_data[config] is None:
+        if config == 'overview' or report_data[config] is None:
             continue
         if 'include_in_summary' not in report_data[config] or not report_data[config]['include_in_summary']:
             continue
-
-        if config == 'weather.yml':
-            weather_data = report_data['weather.yml']
-            location = weather_data.get(
-                'location_name', 'the specified location')
-            summary += f"- Weather information for {location}\n"
-
-            if 'hazards' in weather_data and weather_data['hazards']:
-                hazards = [re.sub('<[^<]+?>', '', hazard)
-                           for hazard in weather_data['hazards']]
-                summary += f"  - Hazardous conditions: {', '.join(hazards)}\n"
-
-            if 'detailed_forecast' in weather_data:
-                today_forecast = next(
-                    iter(
-                        weather_data['detailed_forecast'].values()),
-                    "No forecast available")
-                today_forecast = re.sub(
-                    '<[^<]+?>', '', today_forecast)  # Remove HTML tags
-                summary += f"  - Today's forecast: {today_forecast}\n"
-        elif config == 'crypto_price.yml':
-            crypto_summary = ", ".join(
-                [f"{c['name']}: ${c['current_price']:.2f} price_change_24h: {c['price_change_24h']}" for c in report_data['crypto_price.yml']['crypto_list']])
-            summary += f"- Cryptocurrency prices (including {crypto_summary})\n"
-        elif config == 'frontpage.yml':
-            newspapers = ", ".join([paper for paper in report_data['frontpage.yml'].keys(
-            ) if paper != 'include_in_summary'])
-            summary += f"- Front page news analysis from {newspapers}\n"
-            for paper in report_data['frontpage.yml']:
-                if paper == 'include_in_summary':
-                    continue
-                summary += f"  - {paper}: {report_data['frontpage.yml'][paper]}\n"
-        elif config == 'stock_market.yml':
-            stock_data = report_data['stock_market.yml']
-            stock_summary = ", ".join(
-                [f"{symbol}: {data['change_percent']}" for symbol, data in stock_data.items()])
-            summary += f"- Stock market summary ({stock_summary})\n"
-        elif config == 'word_of_day.yml':
-            word_data = report_data['word_of_day.yml']
-            summary += f"- Word of the Day: {word_data['word']}\n"
-        elif config == 'daily_quote.yml':
-            quote_data = report_data['daily_quote.yml']
-            summary += f"- Daily Quote by {quote_data['author']}\n"
-        elif config == 'traffic_analyzer.yml':
-            traffic_data = report_data['traffic_analyzer.yml']
-            summary += f"- Traffic analysis {traffic_data['analysis']}\n"
+        inputs[config] = report_data[config]
+    return inputs
+
+
+def compact_summary_sections(inputs, sections):
+    """
+    Strip markup, drop stories repeated across newspapers and fit the
+    sections into OVERVIEW_TOKEN_BUDGET, weighting each module by its
+    include_in_summary value (true counts as 1).
+    """
+    compacted = {}
+    for config, text in sections.items():
+        if config == 'frontpage.yml':
+            papers = {paper: compaction.html_blocks(data['analysis'])
+                      for paper, data in inputs[config].items()
+                      if paper != 'include_in_summary'}
+            papers, dropped = compaction.dedupe_blocks(papers)
+            if dropped:
+                logging.info(f"Dropped {dropped} front page stories repeated across papers")
+            text = f"- Front page news analysis from {', '.join(papers)}\n"
+            for paper, blocks in papers.items():
+                text += f"  - {paper}: {' '.join(blocks)}\n"
         else:
-            data = report_data[config]
-            summary += f"- Unnamed data {data}\n"
+            text = compaction.strip_markup(text) + "\n"
+        compacted[config] = text
 
-    prompt = f"""Create a concise overview of today's report, highlighting the most important points and any notable trends. The overview should be engaging, informative, and action-oriented, suitable as the opening of a daily brief email for busy professionals.
+    weights = {config: float(inputs[config]['include_in_summary'])
+               for config in compacted}
+    compacted = compaction.compact_sections(
+        compacted, weights, OVERVIEW_TOKEN_BUDGET)
 
-Start the overview directly with the content, without any introductory phrases. The tone should be professional and insightful. Focus on providing key takeaways that the reader can use to inform their day.
+    saved = (sum(compaction.estimate_tokens(t) for t in sections.values()) -
+             sum(compaction.estimate_tokens(t) for t in compacted.values()))
+    logging.info(f"Overview prompt compaction saved about {saved} input tokens")
+    metrics.increment('overview_tokens_saved', saved)
+    return compacted
 
-Limit the overview to 1-3 paragraphs. Avoid broad generalizations or philosophical musings about the interconnectedness of events. Instead, concentrate on specific, important information and its potential impact on the reader's day or decisions.
 
-Summary of report contents:
-{summary}
+def _price_moved(previous, current, threshold_pct):
+    if previous == current:
+        return False
+    if not previous:
+        return True
+    return abs(current - previous) / abs(previous) * 100 >= threshold_pct
+
+
+def diff_report(previous, current):
+    """
+    Compare summary inputs with those of the previous overview.
+    Returns {module: reason} for every module that changed materially.
+    Price modules use the `materiality.price_change_pct` threshold from
+    their YAML; other modules change when their summary text does.
+    """
+    changes = {}
+    for module in list(previous) + [m for m in current if m not in previous]:
+        if module not in current:
+            changes[module] = 'removed'
+            continue
+        if module not in previous:
+            changes[module] = 'added'
+            continue
 
-Format your response in HTML, using appropriate tags for structure and emphasis."""
+        config = load_module(module) or {}
+        materiality = config.get('materiality', {})
+        old, new = previous[module], current[module]
+        if module == 'crypto_price.yml':
+            threshold = materiality.get('price_change_pct', 1.0)
+            old_prices = {c['name']: c['current_price'] for c in old['crypto_list']}
+            new_prices = {c['name']: c['current_price'] for c in new['crypto_list']}
+            moved = [name for name in new_prices
+                     if name not in old_prices or _price_moved(old_prices[name], new_prices[name], threshold)]
+            if moved or set(old_prices) - set(new_prices):
+                changes[module] = f"prices moved: {', '.join(moved) or 'coins removed'}"
+        elif module == 'stock_market.yml':
+            threshold = materiality.get('price_change_pct', 0.5)
+            symbols = [s for s in set(old) | set(new) if s != 'include_in_summary']
+            moved = [symbol for symbol in symbols
+                     if symbol not in old or symbol not in new
+                     or _price_moved(old[symbol]['price'], new[symbol]['price'], threshold)]
+            if moved:
+                changes[module] = f"prices moved: {', '.join(sorted(moved))}"
+        elif summarize_section(module, old) != summarize_section(module, new):
+            changes[module] = 'content changed'
+    return changes
+
+
+def generate_overview(report_data):
+    inputs = summary_inputs(report_data)
+    sections = {config: summarize_section(config, data)
+                for config, data in inputs.items()}
+
+    cache_path = get_cache_path('overview')
+    previous = None
+    if is_cache_valid(cache_path):
+        with open(cache_path, 'r') as cache_file:
+            previous = json.load(cache_file)['data']
+        # Updates carry the time of the last full generation, so a chain of
+        # updates never keeps an overview past OVERVIEW_MAX_AGE
+        if time.time() - previous.get('generated', 0) >= OVERVIEW_MAX_AGE:
+            logging.info("Stored overview is too old, regenerating it")
+            previous = None
+
+    if previous is not None:
+        changes = diff_report(previous['inputs'], inputs)
+        if not changes:
+            # Keep the stored inputs as the baseline so that small moves
+            # add up until one of them is material
+            logging.info("No material changes since the last overview, reusing it")
+            return previous['overview']
+
+        if len(changes) <= len(inputs) * OVERVIEW_UPDATE_FRACTION:
+            logging.info(f"Updating overview for changed sections: {changes}")
+            prompt_sections = compact_summary_sections(inputs, sections)
+            changed_sections = "".join(
+                prompt_sections.get(module, f"- {module} is no longer included\n")
+                for module in changes)
+            prompt = OVERVIEW_UPDATE_PROMPT.format(
+                overview=previous['overview'], changes=changed_sections)
+            logging.debug(f"Prompt being sent: {prompt}")
+            overview = generate_anthropic_response(
+                [{'role': 'user', 'content': prompt}],
+                tier='light',
+                max_tokens=1024)[0].text
+            write_cache(cache_path, {
+                'timestamp': time.time(),
+                'data': {
+                    'inputs': inputs,
+                    'overview': overview,
+                    'generated': previous['generated']}})
+            return overview
+
+    # Prepare a summary of the report data
+    prompt_sections = compact_summary_sections(inputs, sections)
+    summary = "Today's report includes:\n"
+    summary += "".join(prompt_sections.values())
+
+    prompt = OVERVIEW_PROMPT.format(summary=summary)
 
     logging.debug(f"Prompt being sent: {prompt}")
 
     overview = generate_anthropic_response(
-        [{'role': 'user', 'content': prompt}])
-    return overview[0].text
+        [{'role': 'user', 'content': prompt}],
+        tier='standard',
+        max_tokens=1024)
+    overview = overview[0].text
+    now = time.time()
+    write_cache(cache_path, {
+        'timestamp': now,
+        'data': {'inputs': inputs, 'overview': overview, 'generated': now}})
+    return overview
+
+
+def deliver_brief(report_data):
+    # Generate overview
+    overview = generate_overview(report_data)
+
+    # Add overview to report data
+    report_data['overview'] = overview
+
+    # Create email body
+    email_body = create_email_body(report_data)
+    metrics.set_email_size(len(email_body.encode('utf-8')))
+
+    # Send email
+    formatted_date = datetime.now().strftime('%A, %b %d, %Y')
+    subject = f"Your Daily Brief for {formatted_date}"
+    send_email(subject, email_body)
+    with open('body.html', 'w') as f:
+        f.write(email_body)
+    logging.info("Daily brief email sent successfully")
+
+
+def process_unit(unit):
+    if unit['kind'] == 'module' and unit['payload']:
+        # Batch of modules without a handler
+        configs = {}
+        for module in unit['payload']['modules']:
+            config = load_module(module)
+            if config:
+                configs[module] = config
+        if not configs:
+            return {}
+        started = time.perf_counter()
+        results = process_generic_modules(configs)
+        metrics.record_module(unit['name'], time.perf_counter() - started)
+        return results
+
+    if unit['kind'] == 'module':
+        config = load_module(unit['name'])
+        if not config:
+            return None
+        started = time.perf_counter()
+        if memory.is_bounded():
+            with memory.track_peak_rss(unit['name']) as rss:
+                result = process_module(unit['name'], config)
+            metrics.record_module(unit['name'], time.perf_counter() - started, rss['peak_mb'])
+        else:
+            result = process_module(unit['name'], config)
+            metrics.record_module(unit['name'], time.perf_counter() - started)
+        return result
+
+    # Render unit: assemble the module results in INCLUDE order
+    results = workqueue.run_results(unit['run_id'])
+    report_data = {}
+    for module in unit['payload']['modules']:
+        if module in results:
+            report_data[module] = results[module]
+    deliver_brief(report_data)
+    return None
+
+
+def save_metrics(unit=None):
+    """
+    Store the metrics of an inline run, or of a completed queue unit: module
+    units are stored for their run, and the render unit saves the run.
+    The brief may already have been sent, so failures are only logged.
+    """
+    # Recorded runs start from an empty cache and replayed runs skip the
+    # network, so either would skew the latency baselines
+    if cassette.mode() is not None:
+        return
+    try:
+        if unit is None:
+            metrics.save_run()
+        elif unit['kind'] == 'module':
+            metrics.save_unit(unit['run_id'])
+        else:
+            metrics.save_run(run_id=unit['run_id'])
+    except Exception as e:
+        logging.warning(f"Could not save run metrics: {str(e)}")
+
+
+def run_worker(worker_id, lease_seconds=300, follow=False, poll_interval=2):
+    logging.info(f"Worker {worker_id} started")
+    while True:
+        if memory.is_bounded():
+            unit = workqueue.claim(
+                worker_id,
+                lease_seconds,
+                limited=IMAGE_MODULES,
+                limit=MAX_IMAGE_MODULES)
+        else:
+            unit = workqueue.claim(worker_id, lease_seconds)
+        if unit is None:
+            # Render units wait on module units leased by other workers,
+            # so only stop once nothing is pending or leased.
+            if not follow and workqueue.is_idle():
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logging.info(
+            f"Worker {worker_id} claimed {unit['kind']} unit {unit['name']} "
+            f"of run {unit['run_id']} (attempt {unit['attempts']})")
+        metrics.reset()
+        try:
+            with workqueue.keep_lease(unit['id'], worker_id, lease_seconds):
+                result = process_unit(unit)
+            completed = workqueue.complete(unit['id'], worker_id, result)
+        except Exception as e:
+            logging.error(f"Unit {unit['name']} of run {unit['run_id']} failed: {str(e)}")
+            logging.error(traceback.format_exc())
+            workqueue.fail(unit['id'], worker_id, e)
+            continue
+        # Saved once the unit is done, so that metrics can never cause a
+        # retry that sends the brief again
+        if completed:
+            save_metrics(unit)
+    logging.info(f"Worker {worker_id} exiting, queue is idle")
+
+
+def run_workers(count, lease_seconds=300, follow=False):
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    if count <= 1:
+        run_worker(prefix, lease_seconds, follow)
+        return
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(f"{prefix}-{i}", lease_seconds, follow))
+        for i in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
 
 def main():
@@ -588,30 +1408,45 @@ def main():
         # Load included modules from .env
         included_modules = os.getenv('INCLUDE', '').split(':')
 
+        metrics.reset()
+
         # Generate report data
         report_data = generate_report(included_modules)
 
-        # Generate overview
-        overview = generate_overview(report_data)
-
-        # Add overview to report data
-        report_data['overview'] = overview
-
-        # Create email body
-        email_body = create_email_body(report_data)
-
-        # Send email
-        formatted_date = datetime.now().strftime('%A, %b %d, %Y')
-        subject = f"Your Daily Brief for {formatted_date}"
-        send_email(subject, email_body)
-        with open('body.html', 'w') as f:
-            f.write(email_body)
-        logging.info("Daily brief email sent successfully")
+        deliver_brief(report_data)
     except Exception as e:
         logging.error(f"Failed to generate or send daily brief: {str(e)}")
         # This will print the full stack trace
         logging.error(traceback.format_exc())
+    else:
+        save_metrics()
 
 
 if __name__ == "__main__":
-    main()
+    if args.enqueue:
+        included_modules = os.getenv('INCLUDE', '').split(':')
+        generic = [module for module in included_modules
+                   if module not in MODULE_HANDLERS]
+        run_id = workqueue.enqueue_run(
+            included_modules,
+            groups={'generic modules': generic} if generic else None)
+        print(f"Queued run {run_id}")
+    if args.worker:
+        run_workers(args.workers, args.lease, args.follow)
+    if not args.enqueue and not args.worker:
+        cache_dir = None
+        if args.record or args.replay:
+            # Start from an empty cache so every external call is recorded,
+            # and replayed in the same order
+            cache_dir = tempfile.mkdtemp(prefix='daily_claude_')
+            os.environ['CACHE_DIR'] = cache_dir
+            if args.record:
+                cassette.start('record', args.record)
+            else:
+                cassette.start('replay', args.replay, args.replay_latency)
+        try:
+            main()
+        finally:
+            cassette.save()
+            if cache_dir:
+                shutil.rmtree(cache_dir, ignore_errors=True)
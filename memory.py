@@ -0,0 +1,73 @@
+"""
+Memory budget and peak RSS reporting for the bounded-memory mode.
+
+The budget is set from --memory-budget or MEMORY_BUDGET_MB. When it is
+set, image-heavy modules render front pages directly at their target size,
+at most MAX_IMAGE_MODULES of them run at once across queue workers, and
+the peak resident set size of every module is logged and checked against
+the budget.
+"""
+import logging
+import os
+import resource
+import sys
+import threading
+from contextlib import contextmanager
+
+
+_budget_mb = None
+
+
+def set_budget(budget_mb):
+    global _budget_mb
+    _budget_mb = float(budget_mb) if budget_mb else None
+
+
+def budget_mb():
+    return _budget_mb
+
+
+def is_bounded():
+    return _budget_mb is not None
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        # No procfs: fall back to the process high-water mark, which
+        # ru_maxrss reports in bytes on macOS and in KB elsewhere.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        return maxrss / divisor
+
+
+@contextmanager
+def track_peak_rss(label, interval=0.02):
+    """
+    Sample RSS in the background while the body runs.
+    Yields a dict whose 'peak_mb' is filled in on exit.
+    """
+    stats = {'peak_mb': current_rss_mb()}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            stats['peak_mb'] = max(stats['peak_mb'], current_rss_mb())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield stats
+    finally:
+        stop.set()
+        thread.join()
+        stats['peak_mb'] = max(stats['peak_mb'], current_rss_mb())
+        logging.info(f"Peak RSS for {label}: {stats['peak_mb']:.1f} MB")
+        if _budget_mb is not None and stats['peak_mb'] > _budget_mb:
+            logging.warning(
+                f"{label} exceeded the memory budget: "
+                f"{stats['peak_mb']:.1f} MB > {_budget_mb:.1f} MB")
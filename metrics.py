@@ -0,0 +1,373 @@
+"""
+Per-run metrics with a persistent history.
+
+During a run, the pipeline records module latencies, cache hits and
+misses (with the per-module data caches also counted on their own),
+Claude calls with their token counts and latency, downloaded bytes and
+the email size. `save_run` stores a snapshot in a SQLite database, which
+can be exported in Prometheus text format or summarized as p50/p95
+trends with regression flags:
+
+    python metrics.py
+    python metrics.py --prometheus
+"""
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    run_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# Upper bounds in seconds for the exported latency histograms
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_run = None
+
+
+def reset():
+    """Start collecting metrics for a new run."""
+    global _run
+    with _lock:
+        _run = {
+            'started': time.time(),
+            'modules': {},
+            'llm_calls': [],
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'module_cache_hits': 0,
+            'module_cache_misses': 0,
+            'bytes_downloaded': 0,
+            'email_bytes': 0,
+            'counters': {},
+        }
+
+
+reset()
+
+
+def record_module(name, seconds, peak_rss_mb=None):
+    with _lock:
+        _run['modules'][name] = {'seconds': seconds}
+        if peak_rss_mb is not None:
+            _run['modules'][name]['peak_rss_mb'] = peak_rss_mb
+
+
+def record_cache(hit, module=False):
+    """
+    Count a cache lookup. Lookups of per-module data caches (module=True)
+    are also counted on their own, apart from fragment, overview and
+    summary lookups.
+    """
+    with _lock:
+        _run['cache_hits' if hit else 'cache_misses'] += 1
+        if module:
+            _run['module_cache_hits' if hit else 'module_cache_misses'] += 1
+
+
+def record_llm(seconds, input_tokens, output_tokens, model=None, tier=None):
+    with _lock:
+        _run['llm_calls'].append({
+            'seconds': seconds,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'model': model,
+            'tier': tier,
+        })
+
+
+def add_bytes(count):
+    with _lock:
+        _run['bytes_downloaded'] += count
+
+
+def set_email_size(count):
+    with _lock:
+        _run['email_bytes'] = count
+
+
+def increment(name, value=1):
+    with _lock:
+        _run['counters'][name] = _run['counters'].get(name, 0) + value
+
+
+def snapshot():
+    """Return the metrics collected so far, with derived totals."""
+    with _lock:
+        data = json.loads(json.dumps(_run))
+    lookups = data['cache_hits'] + data['cache_misses']
+    data['cache_hit_rate'] = data['cache_hits'] / lookups if lookups else None
+    module_lookups = data['module_cache_hits'] + data['module_cache_misses']
+    data['module_cache_hit_rate'] = (
+        data['module_cache_hits'] / module_lookups if module_lookups else None)
+    data['llm_input_tokens'] = sum(c['input_tokens'] for c in data['llm_calls'])
+    data['llm_output_tokens'] = sum(c['output_tokens'] for c in data['llm_calls'])
+    data['llm_seconds'] = sum(c['seconds'] for c in data['llm_calls'])
+    return data
+
+
+def get_metrics_path():
+    path = os.getenv('METRICS_PATH', os.path.join('data', 'metrics.db'))
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    return path
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or get_metrics_path(), timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def save_unit(run_id, path=None):
+    """
+    Store the metrics of one unit of a queued run, to be merged into the
+    run by the worker that saves it.
+    """
+    with _lock:
+        data = json.dumps(_run)
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute("INSERT INTO units (run_id, data) VALUES (?, ?)", (run_id, data))
+    finally:
+        conn.close()
+
+
+def merge(data):
+    """Add the metrics of another unit of the same run to the current run."""
+    with _lock:
+        _run['started'] = min(_run['started'], data['started'])
+        _run['modules'].update(data['modules'])
+        _run['llm_calls'].extend(data['llm_calls'])
+        for key in ('cache_hits', 'cache_misses', 'module_cache_hits',
+                    'module_cache_misses', 'bytes_downloaded'):
+            _run[key] += data.get(key, 0)
+        _run['email_bytes'] = _run['email_bytes'] or data['email_bytes']
+        for name, value in data['counters'].items():
+            _run['counters'][name] = _run['counters'].get(name, 0) + value
+
+
+def save_run(path=None, run_id=None):
+    """
+    Store a snapshot of the current run and return it. For a queued run,
+    the metrics saved by its other units are merged in first.
+    """
+    conn = connect(path)
+    try:
+        if run_id is not None:
+            with conn:
+                rows = conn.execute(
+                    "SELECT data FROM units WHERE run_id = ?", (run_id,)).fetchall()
+                conn.execute("DELETE FROM units WHERE run_id = ?", (run_id,))
+            for row in rows:
+                merge(json.loads(row[0]))
+        data = snapshot()
+        duration = time.time() - data['started']
+        data['duration'] = duration
+        with conn:
+            conn.execute(
+                "INSERT INTO runs (started, duration, data) VALUES (?, ?, ?)",
+                (data['started'], duration, json.dumps(data)))
+    finally:
+        conn.close()
+    return data
+
+
+def load_runs(limit=30, path=None):
+    """Return up to `limit` most recent run snapshots, oldest first."""
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT data FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    finally:
+        conn.close()
+    return [json.loads(row[0]) for row in reversed(rows)]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def _histogram(lines, name, label, series):
+    for key, values in sorted(series.items()):
+        for bound in BUCKETS:
+            count = sum(1 for v in values if v <= bound)
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {len(values)}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {sum(values)}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {len(values)}')
+
+
+def to_prometheus(runs):
+    """
+    Render the latest run as gauges and the latency history of all given
+    runs as histograms, in Prometheus text exposition format.
+    """
+    if not runs:
+        return ""
+    latest = runs[-1]
+    lines = []
+
+    def gauge(name, help_text, value, labels=""):
+        if value is None:
+            return
+        if f"# TYPE {name} gauge" not in lines:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{labels} {value}")
+
+    gauge('daily_brief_run_duration_seconds', 'Duration of the latest run.', latest['duration'])
+    for module, stats in sorted(latest['modules'].items()):
+        gauge('daily_brief_module_seconds', 'Module latency in the latest run.',
+              stats['seconds'], f'{{module="{module}"}}')
+    for module, stats in sorted(latest['modules'].items()):
+        gauge('daily_brief_module_peak_rss_megabytes', 'Module peak RSS in the latest run.',
+              stats.get('peak_rss_mb'), f'{{module="{module}"}}')
+    gauge('daily_brief_cache_hit_ratio', 'Cache hit rate of the latest run.', latest['cache_hit_rate'])
+    gauge('daily_brief_module_cache_hit_ratio', 'Module data cache hit rate of the latest run.',
+          latest.get('module_cache_hit_rate'))
+    gauge('daily_brief_llm_calls', 'Claude calls in the latest run.', len(latest['llm_calls']))
+    gauge('daily_brief_llm_input_tokens', 'Claude input tokens in the latest run.', latest['llm_input_tokens'])
+    gauge('daily_brief_llm_output_tokens', 'Claude output tokens in the latest run.', latest['llm_output_tokens'])
+    gauge('daily_brief_llm_seconds', 'Time spent in Claude calls in the latest run.', latest['llm_seconds'])
+    gauge('daily_brief_downloaded_bytes', 'Bytes downloaded in the latest run.', latest['bytes_downloaded'])
+    gauge('daily_brief_email_bytes', 'Size of the latest email body.', latest['email_bytes'])
+    for name, value in sorted(latest['counters'].items()):
+        gauge(f'daily_brief_{name}', f'Counter {name} in the latest run.', value)
+
+    module_series = {}
+    llm_series = {}
+    for run in runs:
+        for module, stats in run['modules'].items():
+            module_series.setdefault(module, []).append(stats['seconds'])
+        for call in run['llm_calls']:
+            llm_series.setdefault(call.get('tier') or 'unknown', []).append(call['seconds'])
+    lines.append("# HELP daily_brief_module_latency_seconds Module latency over recent runs.")
+    lines.append("# TYPE daily_brief_module_latency_seconds histogram")
+    _histogram(lines, 'daily_brief_module_latency_seconds', 'module', module_series)
+    lines.append("# HELP daily_brief_llm_latency_seconds Claude call latency over recent runs.")
+    lines.append("# TYPE daily_brief_llm_latency_seconds histogram")
+    _histogram(lines, 'daily_brief_llm_latency_seconds', 'tier', llm_series)
+    return "\n".join(lines) + "\n"
+
+
+def find_regressions(runs, threshold=1.5, min_delta=0.5):
+    """
+    Compare each module's latency in the latest run with the median of the
+    earlier runs. Returns (module, latest, baseline) for every module that
+    is more than `threshold` times and `min_delta` seconds slower.
+    """
+    if len(runs) < 2:
+        return []
+    latest, history = runs[-1], runs[:-1]
+    regressions = []
+    for module, stats in sorted(latest['modules'].items()):
+        baseline = [run['modules'][module]['seconds']
+                    for run in history if module in run['modules']]
+        if not baseline:
+            continue
+        median = percentile(baseline, 50)
+        if stats['seconds'] > median * threshold and stats['seconds'] - median > min_delta:
+            regressions.append((module, stats['seconds'], median))
+    return regressions
+
+
+def format_report(runs, threshold=1.5):
+    if not runs:
+        return "No runs recorded yet."
+    lines = [f"Last {len(runs)} runs", ""]
+    lines.append(f"{'module':<28}{'runs':>6}{'p50':>9}{'p95':>9}{'latest':>9}")
+
+    series = {}
+    for run in runs:
+        series.setdefault('(total)', []).append(run['duration'])
+        for module, stats in run['modules'].items():
+            series.setdefault(module, []).append(stats['seconds'])
+    for module, values in sorted(series.items()):
+        lines.append(
+            f"{module:<28}{len(values):>6}{percentile(values, 50):>9.2f}"
+            f"{percentile(values, 95):>9.2f}{values[-1]:>9.2f}")
+
+    tiers = {}
+    for run in runs:
+        for call in run['llm_calls']:
+            key = (call.get('tier') or 'unknown', call.get('model') or 'unknown')
+            tiers.setdefault(key, []).append(call['seconds'])
+    if tiers:
+        lines.append("")
+        lines.append(f"{'LLM tier / model':<44}{'calls':>6}{'p50':>9}{'p95':>9}")
+        for (tier, model), values in sorted(tiers.items()):
+            lines.append(
+                f"{f'{tier} / {model}':<44}{len(values):>6}"
+                f"{percentile(values, 50):>9.2f}{percentile(values, 95):>9.2f}")
+
+    latest = runs[-1]
+    hit_rate = latest['cache_hit_rate']
+    module_hit_rate = latest.get('module_cache_hit_rate')
+    lines.append("")
+    lines.append(
+        f"Latest run: {len(latest['llm_calls'])} LLM calls, "
+        f"{latest['llm_input_tokens']} input / {latest['llm_output_tokens']} output tokens, "
+        f"{latest['llm_seconds']:.2f}s in Claude, "
+        f"cache hit rate {'n/a' if hit_rate is None else f'{hit_rate:.0%}'} "
+        f"(modules {'n/a' if module_hit_rate is None else f'{module_hit_rate:.0%}'}), "
+        f"{latest['bytes_downloaded']} bytes downloaded, "
+        f"email {latest['email_bytes']} bytes")
+
+    regressions = find_regressions(runs, threshold)
+    lines.append("")
+    if regressions:
+        for module, seconds, baseline in regressions:
+            lines.append(
+                f"REGRESSION {module}: {seconds:.2f}s vs baseline {baseline:.2f}s "
+                f"({seconds / baseline if baseline else float('inf'):.1f}x)")
+    else:
+        lines.append(f"No module slower than {threshold}x its recent baseline.")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--prometheus',
+        action='store_true',
+        help='Print metrics in Prometheus text format instead of the report')
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=30,
+        help='Number of recent runs to include')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.5,
+        help='Flag modules slower than this multiple of their recent median')
+    args = parser.parse_args()
+
+    recent_runs = load_runs(args.runs)
+    if args.prometheus:
+        print(to_prometheus(recent_runs), end="")
+    else:
+        print(format_report(recent_runs, args.threshold))
+        if find_regressions(recent_runs, args.threshold):
+            raise SystemExit(1)
@@ -0,0 +1,217 @@
+"""
+Local pools of prefetched content for the word of the day and daily quote.
+
+A bulk prefetch job fills a SQLite database with entries ahead of time:
+
+    python pools.py --prefetch
+
+The daily run then picks an entry with `select`, which is a local lookup.
+Picks are deterministic for a given date and never repeat an entry within
+the configured window while unused entries remain.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+import yaml
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    pool TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (pool, key)
+);
+CREATE TABLE IF NOT EXISTS picks (
+    pool TEXT NOT NULL,
+    day TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (pool, day)
+);
+"""
+
+WORD_POOL = 'word_of_day'
+QUOTE_POOL = 'daily_quote'
+
+
+def get_pools_path():
+    path = os.getenv('POOLS_PATH', os.path.join('data', 'pools.db'))
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    return path
+
+
+def connect(path=None):
+    conn = sqlite3.connect(path or get_pools_path(), timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_entries(pool, entries, path=None):
+    """Store {key: data} entries in a pool, replacing existing keys."""
+    now = time.time()
+    conn = connect(path)
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (pool, key, data, fetched) VALUES (?, ?, ?, ?)",
+                [(pool, key, json.dumps(data), now) for key, data in entries.items()])
+    finally:
+        conn.close()
+
+
+def pool_keys(pool, path=None):
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT key FROM entries WHERE pool = ?", (pool,)).fetchall()
+        return {row[0] for row in rows}
+    finally:
+        conn.close()
+
+
+def _rank(pool, day, key):
+    return hashlib.sha256(f"{pool}:{day}:{key}".encode('utf-8')).hexdigest()
+
+
+def select(pool, day=None, window_days=365, path=None):
+    """
+    Return the entry picked for `day` (default today), or None if the pool
+    is empty. The same day always yields the same entry.
+    """
+    day = (day or date.today()).isoformat()
+    conn = connect(path)
+    try:
+        with conn:
+            row = conn.execute(
+                "SELECT e.data FROM picks p JOIN entries e "
+                "ON e.pool = p.pool AND e.key = p.key "
+                "WHERE p.pool = ? AND p.day = ?",
+                (pool, day)).fetchone()
+            if row:
+                return json.loads(row[0])
+
+            keys = [r[0] for r in conn.execute(
+                "SELECT key FROM entries WHERE pool = ?", (pool,))]
+            if not keys:
+                return None
+
+            # Last pick date per key, for keys picked before this day
+            last_picked = dict(conn.execute(
+                "SELECT key, MAX(day) FROM picks WHERE pool = ? AND day < ? GROUP BY key",
+                (pool, day)).fetchall())
+            window_start = (date.fromisoformat(day) -
+                            timedelta(days=window_days)).isoformat()
+            candidates = [k for k in keys
+                          if last_picked.get(k, '') <= window_start]
+            if not candidates:
+                # Pool is smaller than the window: reuse the entries that
+                # were picked longest ago
+                oldest = min(last_picked.get(k, '') for k in keys)
+                candidates = [k for k in keys if last_picked.get(k, '') == oldest]
+
+            key = min(candidates, key=lambda k: _rank(pool, day, k))
+            # Another worker may have picked for this day concurrently;
+            # keep whichever pick landed first
+            conn.execute(
+                "INSERT OR IGNORE INTO picks (pool, day, key) VALUES (?, ?, ?)",
+                (pool, day, key))
+            row = conn.execute(
+                "SELECT e.data FROM picks p JOIN entries e "
+                "ON e.pool = p.pool AND e.key = p.key "
+                "WHERE p.pool = ? AND p.day = ?",
+                (pool, day)).fetchone()
+            return json.loads(row[0])
+    finally:
+        conn.close()
+
+
+def fetch_word(api_url, word):
+    response = requests.get(f"{api_url}{word}")
+    if response.status_code != 200:
+        logging.warning(f"Failed to fetch definition of {word}: {response.status_code}")
+        return None
+    data = response.json()[0]
+    return {
+        'word': data['word'],
+        'definition': data['meanings'][0]['definitions'][0]['definition'],
+        'example': data['meanings'][0]['definitions'][0].get('example', 'N/A')}
+
+
+def prefetch_words(config, path=None):
+    """Look up every word in the configured word list that is not pooled yet."""
+    pool_config = config.get('pool', {})
+    with open(pool_config['words_file'], 'r') as f:
+        words = [line.strip() for line in f
+                 if line.strip() and not line.startswith('#')]
+    missing = sorted(set(words) - pool_keys(WORD_POOL, path))
+    logging.info(f"Prefetching {len(missing)} of {len(words)} words")
+
+    api_url = config['api']['url']
+    with ThreadPoolExecutor(max_workers=pool_config.get('concurrency', 4)) as executor:
+        results = executor.map(lambda word: fetch_word(api_url, word), missing)
+        entries = {word: data for word, data in zip(missing, results) if data}
+    add_entries(WORD_POOL, entries, path)
+    return len(entries)
+
+
+def prefetch_quotes(config, path=None):
+    """Page through the bulk quotes endpoint and pool every quote."""
+    pool_config = config.get('pool', {})
+    bulk_url = pool_config['bulk_url']
+    entries = {}
+    page, total_pages = 1, pool_config.get('pages', 5)
+    while page <= total_pages:
+        response = requests.get(
+            bulk_url, params={'limit': pool_config.get('limit', 150), 'page': page})
+        if response.status_code != 200:
+            logging.warning(f"Failed to fetch quotes page {page}: {response.status_code}")
+            break
+        data = response.json()
+        for quote in data['results']:
+            entries[quote['_id']] = {
+                'content': quote['content'],
+                'author': quote['author']}
+        total_pages = min(total_pages, data.get('totalPages', total_pages))
+        page += 1
+    add_entries(QUOTE_POOL, entries, path)
+    return len(entries)
+
+
+def load_config(module_name):
+    with open(f"modules/{module_name}", 'r') as file:
+        return yaml.safe_load(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--prefetch',
+        choices=['all', 'words', 'quotes'],
+        default='all',
+        help='Which pools to fill')
+    parser.add_argument(
+        '--loglevel',
+        default='INFO',
+        help='Set the logging level')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.loglevel.upper(),
+        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.prefetch in ('all', 'words'):
+        count = prefetch_words(load_config('word_of_day.yml'))
+        print(f"Pooled {count} new words")
+    if args.prefetch in ('all', 'quotes'):
+        count = prefetch_quotes(load_config('daily_quote.yml'))
+        print(f"Pooled {count} quotes")
@@ -0,0 +1,296 @@
+"""
+Durable work queue for spreading brief generation across worker processes.
+
+A run is split into one unit per module plus a single render unit that
+becomes claimable once every module unit of the run has finished. The
+queue lives in a SQLite database inside the cache directory, so worker
+processes on this host, or on other hosts sharing that directory, can
+claim units under a time-limited lease. A unit whose lease runs out is
+handed to another worker, and failed units are retried with backoff up
+to max_attempts.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    payload TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    lease_owner TEXT,
+    lease_expires REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS units_status ON units (status, not_before);
+CREATE INDEX IF NOT EXISTS units_run ON units (run_id, kind);
+"""
+
+# A render unit may only be claimed when none of its run's module units
+# are still pending or leased.
+CLAIMABLE = """
+SELECT * FROM units
+WHERE status = 'pending'
+  AND not_before <= ?
+  AND (kind = 'module' OR NOT EXISTS (
+      SELECT 1 FROM units AS m
+      WHERE m.run_id = units.run_id
+        AND m.kind = 'module'
+        AND m.status IN ('pending', 'leased')))
+{limit_clause}
+ORDER BY kind = 'render', id
+LIMIT 1
+"""
+
+# Skip the limited names while `limit` of them are already leased
+LIMIT_CLAUSE = """
+  AND (name NOT IN ({names}) OR (
+      SELECT COUNT(*) FROM units AS l
+      WHERE l.status = 'leased' AND l.name IN ({names})) < ?)
+"""
+
+
+def get_queue_path():
+    cache_dir = os.getenv('CACHE_DIR', 'cache')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return os.getenv('QUEUE_PATH', os.path.join(cache_dir, 'queue.db'))
+
+
+def connect(path=None):
+    # Autocommit mode so that transactions are opened explicitly with
+    # BEGIN IMMEDIATE, which takes the write lock before reading.
+    conn = sqlite3.connect(
+        path or get_queue_path(),
+        timeout=30,
+        isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def enqueue_run(modules, run_id=None, max_attempts=3, groups=None, path=None):
+    """
+    Queue one unit per module and a render unit for the whole run.
+    groups maps a unit name to modules that are processed together in a
+    single unit, whose result is a {module: result} dict.
+    Returns the run id.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    groups = groups or {}
+    grouped = {module for members in groups.values() for module in members}
+    now = time.time()
+    conn = connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for module in modules:
+            if module in grouped:
+                continue
+            conn.execute(
+                "INSERT INTO units (run_id, kind, name, max_attempts, created, updated) "
+                "VALUES (?, 'module', ?, ?, ?, ?)",
+                (run_id, module, max_attempts, now, now))
+        for name, members in groups.items():
+            conn.execute(
+                "INSERT INTO units (run_id, kind, name, payload, max_attempts, created, updated) "
+                "VALUES (?, 'module', ?, ?, ?, ?, ?)",
+                (run_id, name, json.dumps({'modules': members}), max_attempts, now, now))
+        conn.execute(
+            "INSERT INTO units (run_id, kind, name, payload, max_attempts, created, updated) "
+            "VALUES (?, 'render', 'render', ?, ?, ?, ?)",
+            (run_id, json.dumps({'modules': modules}), max_attempts, now, now))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    logging.info(f"Queued run {run_id} for {len(modules)} modules")
+    return run_id
+
+
+def _expire_leases(conn, now):
+    # Leases that ran out go back to pending, or to failed if the unit has
+    # used up its attempts, so a crashed worker never blocks a render unit.
+    conn.execute(
+        "UPDATE units SET status = 'failed', error = 'lease expired', updated = ? "
+        "WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts",
+        (now, now))
+    conn.execute(
+        "UPDATE units SET status = 'pending', lease_owner = NULL, updated = ? "
+        "WHERE status = 'leased' AND lease_expires < ?",
+        (now, now))
+
+
+def claim(worker_id, lease_seconds=300, limited=None, limit=None, path=None):
+    """
+    Lease the next claimable unit to worker_id.
+    If limited is given, at most `limit` units with those names are leased
+    at once across all workers.
+    Returns the unit as a dict, or None if nothing is claimable right now.
+    """
+    now = time.time()
+    params = [now]
+    limit_clause = ""
+    if limited and limit is not None:
+        names = ", ".join("?" for _ in limited)
+        limit_clause = LIMIT_CLAUSE.format(names=names)
+        params += list(limited) + list(limited) + [limit]
+    query = CLAIMABLE.format(limit_clause=limit_clause)
+
+    conn = connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _expire_leases(conn, now)
+        row = conn.execute(query, params).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE units SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+            "attempts = attempts + 1, updated = ? WHERE id = ?",
+            (worker_id, now + lease_seconds, now, row['id']))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    unit = dict(row)
+    unit['attempts'] += 1
+    unit['payload'] = json.loads(unit['payload']) if unit['payload'] else None
+    return unit
+
+
+def renew(unit_id, worker_id, lease_seconds=300, path=None):
+    """Extend a lease. Returns False if the worker no longer holds it."""
+    now = time.time()
+    conn = connect(path)
+    try:
+        cursor = conn.execute(
+            "UPDATE units SET lease_expires = ?, updated = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (now + lease_seconds, now, unit_id, worker_id))
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+@contextmanager
+def keep_lease(unit_id, worker_id, lease_seconds=300, path=None):
+    """Renew a lease in the background while the body runs."""
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            if not renew(unit_id, worker_id, lease_seconds, path):
+                logging.warning(f"Lost lease on unit {unit_id}")
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def complete(unit_id, worker_id, result=None, path=None):
+    """Mark a leased unit as done and store its JSON-serializable result."""
+    conn = connect(path)
+    try:
+        cursor = conn.execute(
+            "UPDATE units SET status = 'done', result = ?, error = NULL, "
+            "lease_owner = NULL, updated = ? "
+            "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (json.dumps(result), time.time(), unit_id, worker_id))
+        if cursor.rowcount != 1:
+            logging.warning(
+                f"Unit {unit_id} was no longer leased by {worker_id}, result dropped")
+            return False
+        return True
+    finally:
+        conn.close()
+
+
+def fail(unit_id, worker_id, error, retry_delay=5, path=None):
+    """
+    Record a failed attempt. The unit is retried after an exponential
+    backoff until it has used up max_attempts.
+    """
+    now = time.time()
+    conn = connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT attempts, max_attempts FROM units "
+            "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+            (unit_id, worker_id)).fetchone()
+        if row is not None:
+            if row['attempts'] >= row['max_attempts']:
+                status, not_before = 'failed', 0
+            else:
+                status = 'pending'
+                not_before = now + retry_delay * 2 ** (row['attempts'] - 1)
+            conn.execute(
+                "UPDATE units SET status = ?, error = ?, not_before = ?, "
+                "lease_owner = NULL, updated = ? WHERE id = ?",
+                (status, str(error), not_before, now, unit_id))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def run_results(run_id, path=None):
+    """
+    Return {module name: result} for the module units of a run, with
+    grouped units expanded into their modules.
+    """
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            "SELECT name, payload, status, result FROM units WHERE run_id = ? AND kind = 'module'",
+            (run_id,)).fetchall()
+    finally:
+        conn.close()
+    results = {}
+    for row in rows:
+        done = row['status'] == 'done' and row['result'] is not None
+        result = json.loads(row['result']) if done else None
+        if row['payload']:
+            for module in json.loads(row['payload'])['modules']:
+                results[module] = (result or {}).get(module)
+        else:
+            results[row['name']] = result
+    return results
+
+
+def is_idle(path=None):
+    """True when no unit is pending or leased."""
+    conn = connect(path)
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*) FROM units WHERE status IN ('pending', 'leased')").fetchone()
+        return row[0] == 0
+    finally:
+        conn.close()